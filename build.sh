@@ -1,5 +1,5 @@
 set -v
-python res/zip.py -s 1 -o nanocli src/* src/*/*
+python res/zip.py -c -s 1 -o nanocli src/*.py src/*/*.py
 echo '#!/usr/bin/env python3' | cat - nanocli.zip > nanocli
 rm nanocli.zip
 chmod 755 nanocli
@@ -0,0 +1,355 @@
+
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+import io, os, sys, json, timeit, platform, subprocess, tempfile
+import numpy as np
+import serial
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+from nanocli import nanocli
+from nanocli.simulator import Simulator
+
+
+def parse_args():
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument('case', nargs='*', default=list(CASES), help='benchmarks to run')
+    parser.add_argument('-t', '--transcripts', help='directory of recorded device replies, recorded from the simulator when missing')
+    parser.add_argument('-p', '--points', default=[ 101, 1001, 10001 ], type=int, nargs='+', help='frequency points')
+    parser.add_argument('-s', '--samples', default=[ 1, 5 ], type=int, nargs='+', help='samples per frequency')
+    parser.add_argument('-n', '--number', type=int, help='runs per timing, picked automatically when not given')
+    parser.add_argument('-o', '--json', help='write results to this json file')
+    parser.add_argument('-b', '--baseline', help='compare with results from this json file')
+    parser.add_argument('-z', '--zipapp', help='time startup of this built nanocli instead of the source tree')
+    return parser.parse_args()
+
+
+class Replay:
+    # serial port stand-in replaying a recorded transcript
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    @property
+    def in_waiting(self):
+        return len(self.data) - self.pos
+
+    def read(self, n=1):
+        d = self.data[self.pos:self.pos+n]
+        self.pos += len(d)
+        return d
+
+    def readline(self):
+        i = self.data.find(b'\n', self.pos)
+        return self.read(i + 1 - self.pos)
+
+    def write(self, data):
+        return len(data)
+
+    def close(self):
+        pass
+
+
+class Recorder(serial.Serial):
+    # serial port keeping everything read from it
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.transcript = bytearray()
+
+    def read(self, n=1):
+        d = super().read(n)
+        self.transcript.extend(d)
+        return d
+
+
+def transcript(points, start=100000, stop=10100000):
+    # a scan reply as the nanovna shell sends it
+    freq = np.linspace(start, stop, points).round().astype(int)
+    rng = np.random.default_rng(0)
+    d = rng.normal(scale=0.5, size=(points, 4))
+    line = [ 'scan {} {} {} 111'.format(start, stop, points) ]
+    for f, x in zip(freq, d):
+        line.append('{} {:.9f} {:.9f} {:.9f} {:.9f}'.format(f, *x))
+    return ('\r\n'.join(line) + '\r\nch> ').encode()
+
+
+def frequencies(points, start=1e6, stop=30e6):
+    return np.linspace(start, stop, points).round()
+
+
+def driver(kind, ser):
+    # the sweep function of a driver talking to the given port
+    fn = nanocli.DRIVERS['saa2' if kind == 'saa2' else 'nanovna'][0]
+    saved = serial.Serial
+    serial.Serial = lambda device: ser
+    try:
+        return fn('replay')
+    finally:
+        serial.Serial = saved
+
+
+def record(kind, points, samples):
+    # the bytes a simulated device sends during one sweep
+    filename = None
+    if args.transcripts:
+        name = '{}-{}-{}.bin'.format(kind, points, samples)
+        filename = os.path.join(args.transcripts, name)
+        if os.path.exists(filename):
+            with open(filename, 'rb') as f:
+                return f.read()
+    sim = Simulator(kind='saa2' if kind == 'saa2' else 'nanovna', binary=kind != 'text')
+    sim.start(register=False)
+    try:
+        ser = Recorder(sim.device)
+        sweep = driver(kind, ser)
+        sweep(freq=frequencies(points), samples=samples, bulk=kind == 'saa2')
+        ser.close()
+    finally:
+        sim.stop()
+    data = bytes(ser.transcript)
+    if filename:
+        os.makedirs(args.transcripts, exist_ok=True)
+        with open(filename, 'wb') as f:
+            f.write(data)
+    return data
+
+
+def legacy_read(ser):
+    ser.readline()
+    result = ''
+    line = ''
+    while True:
+        c = ser.read().decode('utf-8')
+        line += c
+        if c == chr(10):
+            result += line
+            line = ''
+        if line.endswith('ch>'):
+            break
+    text = result.strip()
+    d = np.array([[ float(c) for c in ln.split() ] for ln in text.split('\n') ])
+    return d[:,1::2] + 1j * d[:,2::2]
+
+
+def buffered_read(ser):
+    buf = bytearray()
+    nanocli.read_line(ser, buf)
+    text = nanocli.read_prompt(ser, buf).decode('utf-8').strip()
+    d = nanocli.parse_scan(text, columns=5)
+    return d[:,1::2] + 1j * d[:,2::2]
+
+
+def legacy_write(freq, data, gamma):
+    line = []
+    line.append('# MHz S MA R 50')
+    entry = ' {:11.5e} {:8.2f}'
+    for f, d in zip(freq, data):
+        one = entry.format(abs(d[0]), np.angle(d[0], deg=True))
+        two = entry.format(abs(d[1]), np.angle(d[1], deg=True))
+        zero = entry.format(0, 0)
+        if gamma:
+            line.append('{:<12.6f}{}'.format(f/1e6, one))
+        else:
+            line.append('{:<12.6f}{}{}{}{}'.format(f/1e6, one, two, zero, zero))
+    return '\n'.join(line)
+
+
+def random_data(*shape):
+    rng = np.random.default_rng(0)
+    return rng.normal(size=shape) + 1j * rng.normal(size=shape)
+
+
+def random_cal(points):
+    cal = { 'start': 1e6, 'stop': 30e6, 'points': points, 'scale': 'lin',
+            'samples': 1, 'average': False, 'bulk': False }
+    for name, d in zip(nanocli.STANDARDS, random_data(len(nanocli.STANDARDS), points)):
+        cal[name] = d
+    return cal
+
+
+###############################
+# benchmarks
+###############################
+
+def bench(fn):
+    timer = timeit.Timer(fn)
+    number = args.number or timer.autorange()[0]
+    return min(timer.repeat(repeat=3, number=number)) / number
+
+
+def result(case, points, fn, samples=None, legacy=None):
+    d = { 'case': case, 'points': points, 'samples': samples, 'seconds': bench(fn) }
+    if legacy is not None:
+        d['legacy'] = bench(legacy)
+    return d
+
+
+def bench_read():
+    for points in args.points:
+        data = transcript(points)
+        a = legacy_read(Replay(data))
+        b = buffered_read(Replay(data))
+        assert(np.array_equal(a, b))
+        yield result('read', points, lambda: buffered_read(Replay(data)),
+                     legacy=lambda: legacy_read(Replay(data)))
+
+
+def bench_write():
+    for points in args.points:
+        freq = frequencies(points)
+        data = random_data(points, 2)
+        text = legacy_write(freq, data, gamma=False)
+        assert(text == nanocli.write_touchstone(freq, data, gamma=False))
+        yield result('write', points,
+                     lambda: nanocli.dump_touchstone(freq, data, io.StringIO(), gamma=False),
+                     legacy=lambda: io.StringIO().write(legacy_write(freq, data, gamma=False)))
+
+
+def bench_touchstone():
+    for points in args.points:
+        text = nanocli.write_touchstone(frequencies(points), random_data(points, 2), gamma=False)
+        yield result('touchstone', points, lambda: nanocli.read_touchstone(text))
+
+
+def bench_parse():
+    for points in args.points:
+        data = transcript(points)
+        text = data[data.index(b'\n')+1:data.rindex(nanocli.PROMPT)].decode().replace('\r', '').strip()
+        yield result('parse', points, lambda: nanocli.parse_scan(text, columns=5))
+
+
+def bench_sweep(kind):
+    # a whole driver sweep replayed from a recorded transcript
+    for points in args.points:
+        for samples in args.samples:
+            data = record(kind, points, samples)
+            freq = frequencies(points)
+            sweep = lambda: driver(kind, Replay(data))(freq=freq, samples=samples, bulk=kind == 'saa2')
+            yield result(kind, points, sweep, samples=samples)
+
+
+def bench_calibrate():
+    for points in args.points:
+        cal = random_cal(points)
+        yield result('calibrate', points, lambda: nanocli.calibrate(cal))
+
+
+def bench_correct():
+    for points in args.points:
+        cal = random_cal(points)
+        cal.update(nanocli.calibrate(cal))
+        data = random_data(points, 2)
+        yield result('correct', points, lambda: nanocli.cal_correct(cal, data))
+
+
+def bench_stack():
+    # correction of 100 frames at once against one frame at a time
+    for points in args.points:
+        cal = random_cal(points)
+        cal.update(nanocli.calibrate(cal))
+        data = random_data(100, points, 2).astype(np.complex64)
+        yield result('stack', points, lambda: nanocli.cal_correct(cal, data, dtype='complex64'),
+                     legacy=lambda: [ nanocli.cal_correct(cal, d) for d in data ])
+
+
+def bench_interpolate():
+    # interpolation from a 101 point calibration, the cache is cleared each run
+    cal = random_cal(101)
+    cal['hash'] = 'bench'
+    def run(points):
+        nanocli.cal_cache.clear()
+        nanocli.cal_interpolate(cal.copy(), start=2e6, stop=29e6, points=points)
+    for points in args.points:
+        yield result('interpolate', points, lambda: run(points))
+
+
+def bench_median():
+    for points in args.points:
+        for samples in args.samples:
+            cal = random_cal(points)
+            cal['samples'] = samples
+            data = random_data(samples, points, 2)
+            sweep = lambda freq, samples, bulk: data
+            yield result('median', points, lambda: nanocli.measure(cal, sweep), samples=samples)
+
+
+def bench_startup():
+    # whole process runs of the cli, as scripts calling it see them
+    src = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+    program = [ sys.executable, args.zipapp or src ]
+    commands = { 'import': [ sys.executable, '-c', 'import nanocli' ],
+                 'help': program + [ '--help' ],
+                 'info': program + [ '--info' ],
+                 'list': program + [ '--list' ] }
+    env = dict(os.environ, PYTHONPATH=src)
+    with tempfile.TemporaryDirectory() as tmp:
+        nanocli.cal_init(1e6, 30e6, 101, samples=1, average=False, bulk=False, 
+                         calfile=os.path.join(tmp, nanocli.CALFILE))
+        for name, argv in commands.items():
+            run = lambda: subprocess.run(argv, cwd=tmp, env=env, check=True,
+                                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            yield result('startup-' + name, None, run)
+
+
+CASES = {
+    'read': bench_read,
+    'write': bench_write,
+    'touchstone': bench_touchstone,
+    'parse': bench_parse,
+    'nanovna': lambda: bench_sweep('nanovna'),
+    'text': lambda: bench_sweep('text'),
+    'saa2': lambda: bench_sweep('saa2'),
+    'calibrate': bench_calibrate,
+    'correct': bench_correct,
+    'stack': bench_stack,
+    'interpolate': bench_interpolate,
+    'median': bench_median,
+    'startup': bench_startup,
+}
+
+
+###############################
+# reporting
+###############################
+
+def commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, cwd=os.path.dirname(__file__)).stdout.strip()
+    except OSError:
+        return None
+
+
+def key(d):
+    return (d['case'], d['points'], d['samples'])
+
+
+def report(results, baseline):
+    print('{:<16} {:>7} {:>7} {:>11} {:>9}'.format('case', 'points', 'samples', 'time', 'speedup'))
+    for d in results:
+        speedup = ''
+        if 'legacy' in d:
+            speedup = '{:.1f}x'.format(d['legacy'] / d['seconds'])
+        elif key(d) in baseline:
+            speedup = '{:.2f}x'.format(baseline[key(d)] / d['seconds'])
+        print('{:<16} {:>7} {:>7} {:>8.3f} ms {:>9}'.format(
+              d['case'], d['points'] or '', d['samples'] or '', d['seconds'] * 1e3, speedup))
+
+
+def main():
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = { key(d): d['seconds'] for d in json.load(f)['results'] }
+    results = [ d for name in args.case for d in CASES[name]() ]
+    report(results, baseline)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({ 'commit': commit(), 'python': platform.python_version(),
+                        'numpy': np.__version__, 'machine': platform.machine(),
+                        'results': results }, f, indent=1)
+
+if __name__ == "__main__":
+    args = parse_args()
+    main()
+
@@ -34,7 +34,7 @@ The utility provides its own error correction.
 It does not use the onboard calibrations features
 of either nano.
 You must calibrate your nano separately to use this utility.
-The calibration data is stored in a npz file on your computer.
+The calibration data is stored in a directory on your computer.
 
 Note, the utility will disturb your nano UI settings (but not on the SAA2).
 So if you sweep a different range of frequencies using nanocli than what the UI is sweeping,
@@ -104,6 +104,11 @@ To do this run:
 
 {run("sh build.sh")}
 
+The executable includes precompiled bytecode, so it does not
+recompile the sources each time it is run.  Numpy and pyserial are
+only imported once a sweep needs them, and --info reads the calibration
+file without numpy, so --help, --info and --list start quickly.
+
 ## Command Line Usage
 
 The utility's command line usage is as follows:
@@ -121,13 +126,68 @@ To calibrate the nano using the utility, first initialize the
 calibration file with your frequency sweep.
 If the calibration
 file already exists, it will be overwritten.  By default
-the name of the file is cal.npz.
+the calibration is kept in the directory cal.
 
 Once intialized the frequency sweep for a given calibration file is fixed.
 All calibrations will use the same sweep range set in the calibration
 file.  This is because all calibration data within a single calibration file
 must have measurements for the same set of frequencies.
 
+Each time a standard is measured, the error terms of the model
+are computed and saved in the calibration file along with the
+raw standards.  A sweep then only applies the stored terms.
+
+The calibration file is a directory holding a header.json with
+the settings of each calibration, and a subdirectory of npy arrays
+for each, which are memory mapped when loaded.  Measuring a standard
+writes only that standard and the error terms under new names, then
+replaces the header, so an interrupted calibration leaves the previous
+one intact.  --info reads only the header.  A store can hold several
+named calibrations, each with its own grid, selected by --calname.
+Without it the calibration named default is used.
+
+```
+$ nanocli --init --calname hf --start 1e6 --stop 30e6
+$ nanocli --open --calname hf
+```
+
+Calibration files from earlier versions, like cal.npz, are copied
+into a store of the same name without the extension, as its
+default calibration, the first time they are used.  The old file
+is left in place.
+
+## Frequency Grids
+
+By default the sweep frequencies are linearly spaced between
+start and stop.  The --log option spaces them logarithmically instead.
+The log grid is made of linear runs, each covering about half an octave,
+so the device can sweep it in a few segments.
+
+The --freqs option takes an explicit list of frequencies, either
+as a file or on the command line, separated by commas or whitespace.
+Entries are single frequencies or start:stop:points bands, with :log
+added for a log band.  Each linear run in the list is swept
+as its own segment.
+
+```
+$ nanocli --init --freqs 1e6:2e6:101,10e6:11e6:101
+$ nanocli --freqs 1.5e6:1.6e6:51
+```
+
+## Adaptive Sampling
+
+With --samples each frequency is measured that many times and
+the median, or with --average the mean, is kept.  Giving --target
+at --init turns the sample count into a limit.  Every frequency is
+first scanned three times, then only the frequencies whose standard
+error is still above the target are scanned again, until they reach
+it or the sample limit.  Quiet stretches of a sweep cost three scans
+while noisy ones, like a high loss thru, get the extra samples.
+
+```
+$ nanocli --init --start 1e6 --stop 30e6 --samples 20 --target 0.003
+```
+
 ## Interpolation of Calibration Data
 
 By default, no interpolation is performed
@@ -145,6 +205,13 @@ Remember, the frequency range cannot be changed
 when doing calibration.  But when making a measurement
 sweep it can.
 
+Interpolated calibrations are kept in memory, keyed by the frequency
+grid and the contents of the calibration file, so a session alternating
+between a few grids only interpolates each once.  With the --cache option
+(or cache=True for getvna) they are also saved in a directory
+next to the calibration file, for example cal.cache, so later runs can reuse them.
+Measuring a standard again clears these cached calibrations.
+
 ## Measurement Report Formats
 
 All measurement output from the utility is
@@ -154,6 +221,104 @@ for a s2p touchstone file.  If the --gamma option
 is passed on the command line the output will be
 formatted for a s1p touchstone file.
 
+The --format option selects how values are written: ma for magnitude
+and angle (the default), db for dB and angle, or ri for real and imaginary.
+Rows are written to stdout in chunks as they are formatted.
+
+For other programs the --format option can also write binary data.
+c64 and c128 write each sweep as a frame of little-endian complex64 or
+complex128 values.  A frame starts with a 20 byte header: the magic NCLI,
+a version byte, the bytes per complex value, the number of columns and
+points, and the sweep time as a float64.  Then come the frequencies as
+float64 and the (points, columns) data.  Frames are self-delimiting,
+so --continuous output can be piped to another process.  npy writes a
+structured array with freq and data fields, and npz writes freq
+and data arrays.
+
+In Python, frame_buffers returns the header and memoryviews of the arrays
+without copying them.  read_frame returns numpy views into any buffer,
+such as a memory-mapped file, and iter_frames reads frames from a pipe.
+
+```python
+with open('sweeps.bin', 'rb') as f:
+    for freq, data, stamp in iter_frames(f):
+        print(stamp, abs(data[:,0]).min())
+```
+
+The --continuous option keeps the device open and sweeps until
+interrupted, while --count runs the given number of sweeps.
+Each sweep is written and flushed as soon as it is measured,
+preceded by a comment line holding its timestamp.
+
+```
+$ nanocli --count 2 --gamma
+! 2026-10-18T10:34:58.112159
+# MHz S MA R 50
+...
+! 2026-10-18T10:34:58.421009
+# MHz S MA R 50
+...
+```
+
+Several devices can be swept at the same time by repeating the --device
+option.  Each device uses the calibration file given in the same position
+by a repeated --calfile option, and no two devices may share one,
+since each has its own error terms.  Every sweep is preceded by
+a comment line naming its device.
+
+```
+$ nanocli --device /dev/ttyACM0 --calfile a --device /dev/ttyACM1 --calfile b
+```
+
+## Sweep Logs
+
+The --record option appends the raw, uncorrected data of every sweep
+to a sweep log, a directory of memory-mapped files.  Each record holds
+the sweep time and ids for its frequency grid and calibration, which
+are stored once in the log.  The log grows as needed, or with --ring
+keeps only the given number of newest sweeps.  With several devices
+each gets its own log, named by adding .0, .1 and so on to the path.
+
+```
+$ nanocli --continuous --record sweeps --ring 1000 > /dev/null
+```
+
+In Python, SweepLog opens a log.  Indexing returns the time, frequencies
+and data of a sweep without reading the others, and between returns
+the sweeps taken in a time range as views into the log.
+
+```python
+log = SweepLog('sweeps')
+stamp, freq, data = log[-1]
+times, grids, data = log.between(time.time() - 60, time.time())
+```
+
+## Sweep Server
+
+Only one process can have the device open.  With --serve nanocli
+keeps the device and its calibrations loaded and takes sweep requests
+over HTTP, on localhost when given a port, on host:port, or on a Unix
+socket when given a path.  GET /sweep takes start, stop, points, log,
+freqs and calname as query parameters, and format and gamma like
+the options of the same name.  The reply is touchstone text or a
+binary frame, with the time of the sweep in an X-Sweep-Time header.
+GET /info returns the calibration details.
+
+```
+$ nanocli --serve 8080 &
+$ curl 'http://localhost:8080/sweep?start=3e6&stop=6e6&points=201&format=db'
+$ nanocli --serve /tmp/nanocli.sock &
+$ curl --unix-socket /tmp/nanocli.sock 'http://localhost/sweep?format=c64' > frame.bin
+```
+
+Requests are queued per client and clients are served in turn, so
+a script sending many requests does not hold off the others.  Clients
+are told apart by an X-Client header, otherwise by host.  Clients on
+a Unix socket all share one host, so each should send its own X-Client.
+A request identical to one waiting or being swept shares that sweep.
+Setting max_age to a number of seconds lets a request be answered
+with the latest identical sweep if it is no older than that.
+
 ## Python Interface
 
 Import this library using import nanocli.  The function
@@ -176,8 +341,78 @@ The function will then return the name of this file.  The file
 extension must be either 's1p' or 's2p'.
 
 ```python
-sweep = getvna(device=None, calname='cal')
-sweep(start=None, stop=None, points=None, filename=None)
+sweep = getvna(device=None, calfile='cal', calname=None)
+sweep(start=None, stop=None, points=None, filename=None, scale=None, freq=None)
+```
+
+Set scale to 'log' for a log grid, or pass an array of frequencies as freq
+to sweep exactly those points.
+
+The object returned by getvna is a Session.  It opens the device on the
+first sweep and keeps it open, so repeated sweeps do not probe
+the serial ports again.  If the USB link drops during a sweep the device
+is opened again and the sweep retried once.  Call close() when done,
+or use the session as a context manager, which also gives the NanoVNA
+its calibration and UI sweep back.
+
+```python
+with Session(device=None, calfile='cal') as sweep:
+    for start in [ 3e6, 4e6, 5e6 ]:
+        f, d = sweep(start=start, stop=start + 1e6)
+```
+
+After each sweep the noise attribute of the session holds the
+standard error of every raw measurement, an array shaped like data,
+or nan when only one sample was taken.
+
+The stream method of a session is a generator yielding corrected
+(freq, data) sweeps as they arrive.  Pass count to limit the number of sweeps.
+
+```python
+for f, d in sweep.stream(start=3e6, stop=6e6, count=None):
+    plot(f, d)
+```
+
+The refine method of a session finds resonances without sweeping
+the whole range again and again.  It takes a coarse sweep, then follows
+the steepest peaks, nulls and zero phase crossings of one column,
+s21 by default, re-sweeping a narrow window around each until the step
+is down to resolution hertz.  The devices sweep whole hertz, so window
+steps are whole hertz too and a resolution below one sweeps no finer.
+Each window gets its own interpolated calibration.  The merged,
+non-uniform sweep is returned and the estimated frequency of each
+feature, placed between the swept points by a fit, is kept in the
+features attribute.  The fit, not the step, gives sub-hertz estimates,
+and how close they come depends on the noise of the measurement.
+
+```python
+f, d = sweep.refine(start=9.95e6, stop=10.05e6, points=101, column=1, 
+                    windows=4, window_points=51, resolution=1)
+for kind, fr in sweep.features:
+    print(kind, fr)
+```
+
+The capture method of a session takes a number of frames in one call
+and returns them as a single (frames, points, 2) array, corrected in one
+pass over the whole stack and stored as complex64 unless dtype says
+otherwise.  With raw set every frame is a single scan, taken back to back
+by one device sweep, rather than the median or mean of the calibration
+samples, so settling and drift can be followed at the scan rate.  The time
+of each frame is kept in the times attribute.
+
+```python
+f, d = sweep.capture(200, start=9e6, stop=11e6, raw=True)
+drift = d[:,:,1] - d[0,:,1]
+```
+
+To sweep several sessions at the same time use sweep_all, or
+asweep_all from asyncio code.  Each session sweeps in its own
+thread and the results are returned in the order of the sessions.
+stream_all yields such a list for every round of sweeps.
+
+```python
+vnas = [ getvna('/dev/ttyACM0', 'a'), getvna('/dev/ttyACM1', 'b') ]
+(f0, d0), (f1, d1) = sweep_all(vnas, start=3e6, stop=6e6)
 ```
 
 For example:
@@ -185,6 +420,70 @@ For example:
 {run("python3 -c 'from nanocli import getvna; f,d = getvna()(start=3e6, stop=6e6); print(d)' | head")}
 
 
+The touchstone reader read_touchstone(text, z0=50) parses s1p to s4p
+text into a (freq, data) tuple, where data has shape (points, ports, ports).
+Data measured with a reference impedance other than z0 is renormalized to z0.
+iter_touchstone takes a list of files or directories and yields
+(filename, freq, data) for one file at a time.
+
+```python
+for name, f, d in iter_touchstone([ 'archive' ]):
+    print(name, abs(d[:,0,0]).min())
+```
+
+## Simulator
+
+The module nanocli.simulator runs a simulated NanoVNA shell or SAA2
+register interface behind a pseudo terminal, so sweeps, calibration
+and timing can be tried without hardware.  The simulated device
+measures a device under test, a calibration standard, a 10 MHz
+series resonator or a 10 MHz crystal, through a fixture with known error terms.  Latency,
+throughput, per point dwell time and noise can be set.  Arguments
+after -- are passed to nanocli.
+
+```
+$ python -m nanocli.simulator --kind saa2 -- --init --start 1e6 --stop 20e6 --points 201
+$ python -m nanocli.simulator --kind saa2 --dut open -- --open
+$ python -m nanocli.simulator --kind saa2 --dut resonator --noise 1e-3 -- --gamma
+```
+
+In Python a running Simulator is probed like a usb device.
+
+```python
+with Simulator(kind='nanovna', throughput=100e3, latency=0.01) as sim:
+    freq, data = Session(device=sim.device)()
+```
+
+## Benchmarks
+
+The script res/bench.py times each stage of a sweep: reading and
+parsing scan replies, whole driver sweeps replayed from transcripts
+recorded off the simulator, calibration, correction of single sweeps
+and of 100 frame stacks, interpolation,
+sample reduction and the touchstone reader and writer.  Results can
+be saved as json with -o and compared against an earlier run with -b.
+
+```
+$ python res/bench.py -p 101 1001 10001 -t transcripts -o before.json
+$ python res/bench.py -p 101 1001 10001 -t transcripts -b before.json
+```
+
+The startup case times whole runs of the cli, or with -z of a built
+executable, for scripts that call it many times.
+
+To see where the time of a real sweep goes, the --timings option
+prints the calls, seconds and bytes of each stage as json on stderr:
+probe, handshake, setup, program, transfer, decode, restore, reduce,
+interpolate, correct and format.  In Python any function added to
+TIMING_HOOKS is called with the stage, seconds and bytes as each stage
+ends, and the Timings class totals them.  With no hooks nothing is timed.
+
+```python
+with Timings() as t:
+    vna()
+print(t.stages['transfer'])
+```
+
 ## Reason for This Utility
 
 I needed the ability to perform a calibrated measurement from the terminal
@@ -201,11 +500,35 @@ and do my remote control in Jupyter instead.
 ## Implementation Notes
 
 In order to perform a measurement sweep on the original nano, the
-utility first turns calibration off on the device.  Once the
-measurement is made, the utility will turn calibration back on.
+utility first turns calibration off on the device.  Calibration is
+turned back on and the UI sweep resumed when the device is closed,
+so a session running many sweeps over the same frequencies only sets
+up the device once.  The scans for all samples of a segment are sent
+together, so the device runs them back to back.
 For the SAA2 nano, since its USB connection is always uncorrected
 its UI and calibration is unaffected.
 
+With the --bulk option set when initializing the calibration file, the SAA2
+takes all samples of a frequency in one programmed sweep
+instead of running a separate sweep for each sample.
+
+Sweeps with more points than the device supports in one scan
+(401 for the NanoVNA, 255 for the SAA2) are split into segments
+that are run back to back and joined into one sweep.  The calibration
+data covers the joined sweep, so each segment is corrected with
+the calibration measured for its own points.
+
+If the NanoVNA firmware lists the scan_bin command in its help
+(DiSlord firmware), scan data is transferred in binary instead
+of text.  Otherwise the text scan output is used.
+
+Devices are found by the USB vendor and product ids of their serial
+ports, without opening any port.  Only the selected device is opened,
+and the port list is reused for a couple of seconds, so --list
+does not disturb ports used by other programs.  A --device given with
+its driver, such as saa2:/dev/ttyACM0, is opened without looking at
+the other ports at all.
+
 ## Supported Nanovna Versions
 
 For the NanoVNA, only versions 0.7.1 and higher of the firmware are supported.
@@ -1,13 +1,15 @@
 
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 from zipfile import ZIP_DEFLATED, ZipFile, ZipInfo
-import os
+from py_compile import compile, PycInvalidationMode
+import os, tempfile
 
 def parse_args():
     parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
     parser.add_argument('filename', nargs='+', help='files to zip up')
     parser.add_argument('-o', '--output', help='output zip file')
     parser.add_argument('-s', '--strip', default=0, type=int, help='remove prefix')
+    parser.add_argument('-c', '--compile', action='store_true', help='add bytecode next to python files')
     return parser.parse_args()
 
 def fileext(filename, ext):
@@ -15,6 +17,16 @@ def fileext(filename, ext):
         filename = f'{filename}.{ext}'
     return filename
 
+def bytecode(filename, name):
+    # zipimport loads a .pyc beside its source, unchecked hash
+    # pycs are used as is without comparing against the source
+    with tempfile.TemporaryDirectory() as tmp:
+        cfile = os.path.join(tmp, 'out.pyc')
+        compile(filename, cfile=cfile, dfile=name, doraise=True,
+                invalidation_mode=PycInvalidationMode.UNCHECKED_HASH)
+        with open(cfile, 'rb') as f:
+            return f.read()
+
 def main():
     if args.output:
         output = fileext(args.output, 'zip')
@@ -25,6 +37,10 @@ def main():
                     zinfo = ZipInfo(os.path.sep.join(d[args.strip:]))
                     with open(filename, 'rb') as f:
                         zf.writestr(zinfo, f.read(), compress_type=ZIP_DEFLATED)
+                    if args.compile and filename.endswith('.py'):
+                        zinfo = ZipInfo(zinfo.filename + 'c')
+                        data = bytecode(filename, zinfo.filename[:-1])
+                        zf.writestr(zinfo, data, compress_type=ZIP_DEFLATED)
 
 if __name__ == "__main__":
     args = parse_args()
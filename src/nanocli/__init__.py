@@ -1,6 +1,17 @@
 
 from .nanocli import (
-    main, getvna, read_touchstone, write_touchstone
+    main, getvna, Session, sweep_all, asweep_all, stream_all,
+    read_touchstone, iter_touchstone, write_touchstone,
+    frame_buffers, write_frame, read_frame, iter_frames,
+    TIMING_HOOKS, Timings
 )
 from .version import __version__
 
+
+def __getattr__(name):
+    # numpy is only imported when the sweep log is used
+    if name == 'SweepLog':
+        from .sweeplog import SweepLog
+        return SweepLog
+    raise AttributeError(name)
+
@@ -1,29 +1,81 @@
 #!/usr/bin/python3
 
-import os, sys, re, serial, argparse
-import numpy as np
-from serial.tools import list_ports
-from struct import pack, unpack_from
+import os, sys, re, io, ast, json, time, argparse, datetime, hashlib, threading
+import importlib.util
+from struct import pack, unpack, unpack_from, calcsize
+from collections import OrderedDict
+from contextlib import ExitStack
+from functools import partial
+
+
+def lazy_import(name):
+    # the module is loaded when one of its attributes is first used,
+    # so --help, --info and --list do not pay for numpy.  packages
+    # whose __init__ imports their own submodules, like asyncio, are
+    # left half loaded this way and are imported where used instead
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+np = lazy_import('numpy')
+serial = lazy_import('serial')
+list_ports = lazy_import('serial.tools.list_ports')
+
+
+def preload():
+    # a lazy module loading in two threads at once can break
+    # before python 3.12, so threads are started only after this
+    for module in (np, serial, list_ports):
+        module.__name__
+
 
 # configuration
 
-CALFILE = 'cal.npz'
+CALFILE = 'cal'
+CALNAME = 'default'
+CAL_VERSION = 1
 CALIBRATIONS = [ 'open', 'short', 'load', 'thru' ]
+STANDARDS = CALIBRATIONS + [ 'thru21' ]
+TERMS = [ 'e00', 'e11', 'de', 'e10e01', 'e22', 'e10e32' ]
 
 DEFAULT_FSTART = 100e3
 DEFAULT_FSTOP = 10.1e6
 DEFAULT_POINTS = 101
 DEFAULT_SAMPLES = 3
 
+CACHE_SIZE = 16  # interpolated calibrations kept in memory
+MIN_SAMPLES = 3  # scans before an adaptive sweep looks at the noise
+RESCAN_GAP = 8   # quiet points between noisy ones re-scanned to save segments
+REFINE_POINTS = 51  # points in each refinement window
+REFINE_WINDOWS = 4  # features followed by a refining sweep
+REFINE_PASSES = 8   # most windows swept around one feature
+
+
+class Repeat(argparse.Action):
+    # like append but the first value given replaces the default
+    def __call__(self, parser, namespace, values, option_string=None):
+        items = getattr(namespace, self.dest)
+        items = [] if items is self.default else items
+        setattr(namespace, self.dest, items + [ values ])
+
 
 def parse_args():
     formatter_class = argparse.ArgumentDefaultsHelpFormatter
     parser = argparse.ArgumentParser(formatter_class=formatter_class)
     # value options 
-    parser.add_argument('--calfile', default=CALFILE, help='calibration file')
+    parser.add_argument('--calfile', action=Repeat, default=[ CALFILE ], help='calibration store, one per device')
+    parser.add_argument('--calname', help='named calibration within the store')
     parser.add_argument('--start', type=float, help='start frequency (Hz)')
     parser.add_argument('--stop', type=float, help='stop frequency (Hz)')
     parser.add_argument('--points', type=int, help='frequency points in sweep')
+    parser.add_argument('--log', action='store_true', help='log frequency spacing')
+    parser.add_argument('--freqs', help='frequency list file or start:stop:points bands')
     # SOLT calibration
     parser.add_argument('--init', action='store_true', help='initialize calibration')
     parser.add_argument('--open', action='store_true', help='open calibration')
@@ -32,9 +84,19 @@ def parse_args():
     parser.add_argument('--thru', action='store_true', help='thru calibration')
     parser.add_argument('--samples', type=int, help='samples per frequency')
     parser.add_argument('--average', action='store_true', help='average samples')
+    parser.add_argument('--bulk', action='store_true', help='take all samples in one sweep (saa2)')
+    parser.add_argument('--target', type=float, help='stop sampling a frequency once its standard error is below this')
     # other flags
+    parser.add_argument('--cache', action='store_true', help='keep interpolated calibrations on disk')
+    parser.add_argument('--record', help='append raw sweeps to this sweep log directory')
+    parser.add_argument('--ring', type=int, help='keep only this many sweeps in the log')
     parser.add_argument('--gamma',  action='store_true', help='output only S11')
-    parser.add_argument('--device', help='tty device name of nanovna to use')
+    parser.add_argument('--format', default='ma', choices=OUTPUT_FORMATS, help='output format')
+    parser.add_argument('--continuous', action='store_true', help='sweep until interrupted')
+    parser.add_argument('--count', type=int, help='number of sweeps to run')
+    parser.add_argument('--serve', metavar='ADDRESS', help='serve sweeps over http on a port, host:port or unix socket path')
+    parser.add_argument('--timings', action='store_true', help='print time spent in each stage as json on stderr')
+    parser.add_argument('--device', action='append', help='tty device name of nanovna to use, prefix with nanovna: or saa2: to skip probing, repeat for more')
     parser.add_argument('-i', '--info',  action='store_true', help='show calibration info')
     parser.add_argument('-l', '--list', action='store_true', help='list available devices')
     args = parser.parse_args()
@@ -73,144 +135,550 @@ def prefix(unit):
         raise ValueError
 
 
-def read_touchstone(text):
-    freq = []
-    data = []
-    dtype = None
-    buf = ''
-    f = iter(text.splitlines())
-    while True:
-        ln = next(f, None)
-        if ln is not None:
-            ln = ln.rstrip()
-            if not ln or ln[0] == '!':
-                continue
-            # handle header line
-            if ln[0] == '#':
-                d = ln[1:].lower().split()
-                if d[1] != 's' or d[3] != 'r' or float(d[4]) != 50:
-                    raise ValueError
-                scale = prefix(d[0])
-                dtype = d[2]
-                continue
-            # handle line continuation
-            if ln[0] == ' ':
-                buf += ln
-                continue
-        if buf:
-            d = [ float(d) for d in buf.split() ]
-            freq.append(d[0] * scale)
-            d = [ rect(d[i], d[i+1], dtype=dtype) for i in range(1, len(d), 2) ]
-            n = int(np.sqrt(len(d)))
-            d = np.array(d).reshape(n, n)
-            data.append(d.T if d.size == 4 else d)
-        if ln is None:
-            break
-        buf = ln
-    freq = np.array(freq)
-    data = np.array(data)
+def read_options(ln):
+    # option line fields may come in any order, defaults per the spec
+    unit, param, dtype, z0 = 'ghz', 's', 'ma', 50
+    d = ln[1:].lower().split()
+    for i, c in enumerate(d):
+        if c in ('hz', 'khz', 'mhz', 'ghz'):
+            unit = c
+        elif c in ('s', 'y', 'z', 'h', 'g'):
+            param = c
+        elif c in ('db', 'ma', 'ri'):
+            dtype = c
+        elif c == 'r' and i + 1 < len(d):
+            z0 = float(d[i+1])
+    if param != 's':
+        raise ValueError
+    return prefix(unit), dtype, z0
+
+
+def infer_ports(count, lines):
+    # s1p and s2p put one frequency on a line, larger
+    # networks wrap every row of the matrix onto its own line
+    fits = []
+    for n in range(1, 5):
+        size = 1 + 2 * n * n
+        if count % size == 0:
+            fits.append(n)
+            if lines == (1 if n <= 2 else n) * count // size:
+                return n
+    if not fits:
+        raise ValueError
+    return fits[0]
+
+
+def renormalize(data, z0, z1):
+    # change the reference impedance of every port from z0 to z1
+    gamma = (z1 - z0) / (z1 + z0)
+    eye = np.eye(data.shape[-1])
+    return np.linalg.solve(eye - gamma * data, data - gamma * eye)
+
+
+def read_touchstone(text, z0=50, ports=None):
+    scale, dtype, ref = 1e9, 'ma', 50
+    body = []
+    for ln in text.splitlines():
+        ln = ln.split('!', 1)[0].strip()
+        if not ln:
+            continue
+        if ln[0] == '#':
+            scale, dtype, ref = read_options(ln)
+        elif ln[0] == '[':
+            raise ValueError
+        else:
+            body.append(ln)
+    # tokenize and convert the whole numeric body at once
+    d = np.array(' '.join(body).split(), dtype=float)
+    n = ports or infer_ports(len(d), len(body))
+    d = d.reshape(-1, 1 + 2 * n * n)
+    freq = d[:,0] * scale
+    data = rect(d[:,1::2], d[:,2::2], dtype=dtype).reshape(-1, n, n)
+    if n == 2:
+        data = data.transpose(0, 2, 1)  # s2p lists S21 before S12
+    if ref != z0:
+        data = renormalize(data, z0=ref, z1=z0)
     return freq, data
 
 
-def write_touchstone(freq, data, gamma):
-    line = []
-    line.append('# MHz S MA R 50')
-    entry = ' {:11.5e} {:8.2f}'
-    for f, d in zip(freq, data):
-        one = entry.format(abs(d[0]), np.angle(d[0], deg=True))
-        two = entry.format(abs(d[1]), np.angle(d[1], deg=True))
-        zero = entry.format(0, 0)
-        if gamma:
-            line.append('{:<12.6f}{}'.format(f/1e6, one))
+def iter_touchstone(filenames, z0=50):
+    # read the files one at a time, a directory yields its touchstone files
+    if isinstance(filenames, str):
+        filenames = [ filenames ]
+    for filename in filenames:
+        if os.path.isdir(filename):
+            names = [ os.path.join(filename, d) for d in sorted(os.listdir(filename)) ]
+            yield from iter_touchstone(
+                [ d for d in names if re.search(r'\.s[1-4]p$', d.lower()) ], z0=z0)
+            continue
+        m = re.search(r'\.s([1-4])p$', filename.lower())
+        with open(filename) as f:
+            text = f.read()
+        freq, data = read_touchstone(text, z0=z0, ports=m and int(m.group(1)))
+        yield filename, freq, data
+
+
+# number format of each value pair, the first is the frequency in MHz
+TOUCHSTONE_FORMATS = {
+    'ma': ' %11.5e %8.2f',
+    'db': ' %8.3f %8.2f',
+    'ri': ' %12.5e %12.5e',
+}
+
+
+def polar(data, dtype):
+    # the inverse of rect for whole arrays
+    if dtype == 'ri':
+        return data.real, data.imag
+    x = np.abs(data)
+    if dtype == 'db':
+        x = 20 * np.log10(np.maximum(x, 1e-30))
+    elif dtype != 'ma':
+        raise ValueError
+    return x, np.angle(data, deg=True)
+
+
+def dump_touchstone(freq, data, file, gamma, dtype='ma', chunk=1024):
+    # write rows in chunks, the unmeasured S12 and S22 are zero
+    file.write('# MHz S {} R 50\n'.format(dtype.upper()))
+    data = np.asarray(data)
+    data = data[:,:1] if gamma else np.concatenate([ data[:,:2], np.zeros_like(data[:,:2]) ], axis=1)
+    x, y = polar(data, dtype=dtype)
+    table = np.empty((len(freq), 1 + 2 * data.shape[1]))
+    table[:,0] = np.asarray(freq) / 1e6
+    table[:,1::2] = x
+    table[:,2::2] = y
+    row = '%-12.6f' + TOUCHSTONE_FORMATS[dtype] * data.shape[1] + '\n'
+    for i in range(0, len(table), chunk):
+        file.write(''.join([ row % tuple(d) for d in table[i:i+chunk].tolist() ]))
+
+
+def write_touchstone(freq, data, gamma, dtype='ma'):
+    f = io.StringIO()
+    dump_touchstone(freq=freq, data=data, file=f, gamma=gamma, dtype=dtype)
+    return f.getvalue()[:-1]
+
+
+###############################
+# binary frames
+###############################
+
+# magic, version, bytes per complex value, columns, points, unix time
+FRAME_HEADER = '<4sBBHId'
+FRAME_MAGIC = b'NCLI'
+FRAME_VERSION = 1
+FRAME_TYPES = { 'c64': 'complex64', 'c128': 'complex128' }
+OUTPUT_FORMATS = list(TOUCHSTONE_FORMATS) + list(FRAME_TYPES) + [ 'npy', 'npz' ]
+
+
+def frame_buffers(freq, data, dtype='complex64', stamp=None):
+    # the header followed by float64 frequencies and the (points, columns)
+    # data, the arrays are only copied if not already of that type
+    freq = np.ascontiguousarray(freq, dtype='<f8')
+    data = np.ascontiguousarray(data, dtype=np.dtype(dtype).newbyteorder('<'))
+    stamp = time.time() if stamp is None else stamp
+    head = pack(FRAME_HEADER, FRAME_MAGIC, FRAME_VERSION, data.itemsize, 
+                data.shape[1], len(freq), stamp)
+    return [ head, memoryview(freq).cast('B'), memoryview(data).cast('B') ]
+
+
+def write_frame(file, freq, data, dtype='complex64', stamp=None):
+    for d in frame_buffers(freq=freq, data=data, dtype=dtype, stamp=stamp):
+        file.write(d)
+
+
+def frame_size(head):
+    magic, version, itemsize, columns, points, stamp = unpack_from(FRAME_HEADER, head)
+    if magic != FRAME_MAGIC or version != FRAME_VERSION:
+        raise ValueError
+    return calcsize(FRAME_HEADER) + points * (8 + itemsize * columns)
+
+
+def read_frame(buf, offset=0):
+    # returns views into buf, which may be bytes, a mmap or any buffer
+    magic, version, itemsize, columns, points, stamp = unpack_from(FRAME_HEADER, buf, offset)
+    if magic != FRAME_MAGIC or version != FRAME_VERSION:
+        raise ValueError
+    offset += calcsize(FRAME_HEADER)
+    freq = np.frombuffer(buf, dtype='<f8', count=points, offset=offset)
+    offset += freq.nbytes
+    dtype = np.dtype('<c{}'.format(itemsize))
+    data = np.frombuffer(buf, dtype=dtype, count=points * columns, offset=offset)
+    offset += data.nbytes
+    return freq, data.reshape(points, columns), stamp, offset
+
+
+def iter_frames(file):
+    # frames from a binary file or pipe, one at a time
+    size = calcsize(FRAME_HEADER)
+    while True:
+        head = file.read(size)
+        if len(head) < size:
+            return
+        buf = head + file.read(frame_size(head) - size)
+        freq, data, stamp, offset = read_frame(buf)
+        yield freq, data, stamp
+
+
+def dump_binary(freq, data, file, gamma, fmt, stamp=None):
+    data = np.asarray(data)
+    data = data[:,:1] if gamma else data
+    if fmt in FRAME_TYPES:
+        write_frame(file, freq=freq, data=data, dtype=FRAME_TYPES[fmt], stamp=stamp)
+    elif fmt == 'npy':
+        dtype = np.dtype([ ('freq', '<f8'), ('data', '<c16', data.shape[1:]) ])
+        d = np.empty(len(freq), dtype=dtype)
+        d['freq'] = freq
+        d['data'] = data
+        np.save(file, d)
+    elif fmt == 'npz':
+        # zip needs a seekable file
+        f = io.BytesIO()
+        np.savez(f, freq=freq, data=data)
+        file.write(f.getvalue())
+    else:
+        raise ValueError
+
+
+###############################
+# timings
+###############################
+
+# callbacks called with (stage, seconds, bytes) as each stage ends,
+# stages are only timed while there is a callback
+TIMING_HOOKS = []
+
+
+class Stage:
+
+    def __init__(self, name):
+        self.name = name
+        self.nbytes = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        for hook in TIMING_HOOKS:
+            hook(self.name, seconds, self.nbytes)
+
+
+class NoStage:
+    nbytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+NO_STAGE = NoStage()
+
+
+def stage(name):
+    return Stage(name) if TIMING_HOOKS else NO_STAGE
+
+
+class Timings:
+    # a hook totalling calls, seconds and bytes per stage
+
+    def __init__(self):
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        TIMING_HOOKS.append(self)
+        return self
+
+    def __exit__(self, *exc):
+        TIMING_HOOKS.remove(self)
+
+    def __call__(self, name, seconds, nbytes):
+        with self.lock:
+            d = self.stages.setdefault(name, { 'calls': 0, 'seconds': 0.0, 'bytes': 0 })
+            d['calls'] += 1
+            d['seconds'] += seconds
+            d['bytes'] += nbytes
+
+
+###############################
+# serial helpers
+###############################
+
+PROMPT = b'ch>'
+
+def read_line(ser, buf):
+    i = buf.find(b'\n')
+    while i < 0:
+        start = len(buf)
+        buf.extend(ser.read(ser.in_waiting or 1))
+        i = buf.find(b'\n', start)
+    line = bytes(buf[:i+1])
+    del buf[:i+1]
+    return line
+
+
+def read_bytes(ser, buf, n):
+    while len(buf) < n:
+        buf.extend(ser.read(max(ser.in_waiting, n - len(buf))))
+    data = bytes(buf[:n])
+    del buf[:n]
+    return data
+
+
+def read_prompt(ser, buf, prompt=PROMPT):
+    # drain the input buffer in bulk until the prompt shows up,
+    # anything past the prompt is kept in buf for the next reply
+    start = 0
+    while True:
+        i = buf.find(prompt, start)
+        if i >= 0:
+            break
+        start = max(0, len(buf) - len(prompt) + 1)
+        buf.extend(ser.read(ser.in_waiting or 1))
+    text = bytes(buf[:i]).replace(b'\r', b'')
+    del buf[:i+len(prompt)]
+    return text
+
+
+def line_widths(text, columns):
+    # whether every line holds columns values, counted as the
+    # starts of runs of non blank characters between newlines
+    b = np.frombuffer(text.encode(), dtype=np.uint8)
+    blank = b <= 32
+    starts = np.flatnonzero(~blank & np.concatenate(([ True ], blank[:-1])))
+    ends = np.concatenate((np.flatnonzero(b == 10), [ len(b) ]))
+    return bool(np.all(np.diff(np.searchsorted(starts, ends), prepend=0) == columns))
+
+
+def parse_scan(text, columns):
+    # parse the whole reply at once, only fall back to a
+    # line by line search to report where a reply went bad
+    try:
+        d = np.array(text.split(), dtype=float)
+        if d.size and d.size == columns * (text.count('\n') + 1) and line_widths(text, columns):
+            return d.reshape(-1, columns)
+    except ValueError:
+        pass
+    for n, ln in enumerate(text.splitlines(), 1):
+        d = ln.split()
+        try:
+            [ float(c) for c in d ]
+        except ValueError:
+            d = None
+        if d is None or len(d) != columns:
+            raise RuntimeError('Malformed scan reply at line {}: {!r}'.format(n, ln))
+    raise RuntimeError('Empty scan reply.')
+
+
+def segments(freq, limit, whole=False):
+    # split a frequency list into the fewest linear runs, each
+    # then cut into back to back runs of at most limit points.
+    # with whole every run has a whole hertz step, for devices
+    # programmed with an integer step
+    runs = []
+    i, n = 0, len(freq)
+    while i < n:
+        j = min(i + 1, n - 1)
+        # a point joins the run while it lies on the line through the
+        # first two, within tol or with whole once rounded to the hertz,
+        # so errors do not build up along it
+        if whole:
+            first = round(freq[i])
+            step = round(freq[j]) - first
+            near = lambda k: round(freq[k]) == first + (k - i) * step
         else:
-            line.append('{:<12.6f}{}{}{}{}'.format(f/1e6, one, two, zero, zero))
-    return '\n'.join(line)
+            step = freq[j] - freq[i]
+            tol = max(0.5, 1e-6 * abs(step))
+            near = lambda k: abs(freq[k] - freq[i] - (k - i) * step) <= tol
+        while j + 1 < n and near(j + 1):
+            j += 1
+        d = freq[i:j+1]
+        runs.extend(np.array_split(d, -(-len(d) // limit)))
+        i = j + 1
+    return [ (round(d[0]), round(d[-1]), len(d)) for d in runs ]
+
+
+def pipeline(jobs, program, collect, decode):
+    # program the device for the next job before decoding
+    # the reply to the current one so the two overlap
+    data = []
+    if jobs:
+        program(jobs[0])
+    for i, job in enumerate(jobs):
+        reply = collect(job)
+        if i + 1 < len(jobs):
+            program(jobs[i+1])
+        data.append(decode(job, reply))
+    return data
+
+
+def stitch(data, count):
+    # join decoded (samples, points, 2) replies, given in
+    # segment order, into a single sweep
+    n = len(data) // count
+    data = [ np.concatenate(data[i:i+n]) for i in range(0, len(data), n) ]
+    return np.concatenate(data, axis=1)
 
 
 ###############################
 # drivers
 ###############################
 
-def nanovna(dev):
+def nanovna(device):
     FSTART = 6348  # si5351 limit
     FSTOP = 2.7e9
     POINTS = 401   # f303 based nanovna
-    VID = 0x0483
-    PID = 0x5740
 
-    def send(ser, cmd):
+    # frequency, S11 and S21 with calibration off, bit 7 asks
+    # DiSlord firmware for binary values instead of text
+    SCAN_MASK = 111
+    SCAN_BINARY_MASK = SCAN_MASK | 0x80
+    SCAN_BINARY = [ ('freq', '<u4'), ('s11', '<c8'), ('s21', '<c8') ]
+    SCAN_BINARY_SIZE = calcsize('<I4f')
+
+    buf = bytearray()
+    binary = None
+    synced = False  # no replies are pending
+    pending = 0     # scans written but not read
+    grid = None     # the sweep set on the device with calibration off
+
+    def write(ser, cmd):
         cmd += '\r'
         ser.write(cmd.encode())
-        ser.readline()
+
+    def send(ser, cmd):
+        write(ser, cmd)
+        read_line(ser, buf)
 
     def read(ser):
-        result = ''
-        line = ''
-        while True:
-            c = ser.read().decode('utf-8')
-            if c == chr(13):
-                next
-            line += c
-            if c == chr(10):
-                result += line
-                line = ''
-                next
-            if line.endswith('ch>'):
-                break
-        return result.strip()
+        return read_prompt(ser, buf).decode('utf-8').strip()
 
-    def command(ser, buf):
-        send(ser, buf)
+    def command(ser, cmd):
+        send(ser, cmd)
         text = read(ser)
         return text
 
     def clear_state(ser):
+        nonlocal binary, pending
+        # drop the replies of scans from a sweep cut short
+        for i in range(pending):
+            read(ser)
+        pending = 0
         for i in range(2): 
             text = command(ser, "help")
             if text[:9] == 'Commands:': break
             text = read(ser)
             if text[:9] == 'Commands:': break
-
-    def scan(ser, start, stop, points):
-        cmd = "scan {:d} {:d} {:d} 111".format(start, stop, points)
-        text = command(ser, cmd)
-        d = np.array([[ float(c) for c in ln.split() ] for ln in text.split('\n') ])
-        assert(len(d) == points)
-        assert(start == d[0,0])
-        assert(stop == d[-1,0])
-        return d[:,1::2] + 1j * d[:,2::2]
-
-    def sweep(start, stop, points, samples):
-        start, stop, points = round(start), round(stop), int(points)
-        assert(stop >= start)
-        assert(start >= FSTART and stop <= FSTOP)
-        assert(points > 0 and points <= POINTS)
+        if binary is None:
+            binary = 'scan_bin' in text.split()
+
+    def check(d, start, stop, points):
+        if len(d) != points or d[0] != start or d[-1] != stop:
+            raise RuntimeError('Scan returned wrong frequencies.')
+
+    def program(job):
+        # all scans of a segment are written at once so they
+        # run back to back on the device
+        nonlocal pending
+        start, stop, points, count = job
+        mask = SCAN_BINARY_MASK if binary else SCAN_MASK
+        pending += count
+        with stage('program'):
+            write(ser, '\r'.join([ f'scan {start} {stop} {points} {mask}' ] * count))
+
+    def collect(job):
+        start, stop, points, count = job
+        with stage('transfer') as st:
+            replies = [ receive(points) for i in range(count) ]
+            st.nbytes = sum(len(raw) for is_binary, raw in replies)
+        return replies
+
+    def receive(points):
+        nonlocal binary, pending
+        read_line(ser, buf)
+        if binary:
+            head = read_bytes(ser, buf, 4)
+            if unpack_from('<HH', head) == (SCAN_BINARY_MASK, points):
+                reply = True, read_bytes(ser, buf, points * SCAN_BINARY_SIZE)
+                read_prompt(ser, buf)
+            else:
+                binary = False  # firmware answered in text
+                reply = False, head + read_prompt(ser, buf)
+        else:
+            reply = False, read_prompt(ser, buf)
+        pending -= 1
+        return reply
+
+    def decode(job, replies):
+        start, stop, points, count = job
+        with stage('decode'):
+            return np.concatenate([ parse(start, stop, points, r) for r in replies ])
+
+    def parse(start, stop, points, reply):
+        is_binary, raw = reply
+        if is_binary:
+            d = np.frombuffer(raw, dtype=SCAN_BINARY)
+            check(d['freq'], start=start, stop=stop, points=points)
+            d = np.stack([ d['s11'], d['s21'] ], axis=1).astype(complex)
+        else:
+            d = parse_scan(raw.decode('utf-8').strip(), columns=5)
+            check(d[:,0], start=start, stop=stop, points=points)
+            d = d[:,1::2] + 1j * d[:,2::2]
+        return d[None]
+
+    def sweep(freq, samples, bulk=False):
+        assert(len(freq) > 0 and np.all(np.diff(freq) > 0))
+        assert(freq[0] >= FSTART and freq[-1] <= FSTOP)
         # since Si5351 multisynth divider ratio < 2048, 6348 is the min freq:
         # 26000000 {xtal} * 32 {pll_n} / (6348 {freq} << 6 {rdiv}) = 2047.9
-        clear_state(ser)
-        # alter ui
-        command(ser, f'sweep {start} {stop} {points}')
-        command(ser, "cal off")
-        data = []
-        for i in range(samples):
-            d = scan(ser, start=start, stop=stop, points=points)
-            data.append(d)
-        data = np.array(data)
-        command(ser, "cal on")
-        command(ser, "resume")  # resume 
+        nonlocal synced, grid
+        # the handshake is only needed when replies may be pending,
+        # before the first sweep or after one was cut short
+        if not synced:
+            with stage('handshake'):
+                clear_state(ser)
+        synced = False
+        # alter ui, left as is while the grid does not change
+        start, stop, points = round(freq[0]), round(freq[-1]), len(freq)
+        if grid != (start, stop, points):
+            with stage('setup'):
+                command(ser, f'sweep {start} {stop} {min(points, POINTS)}')
+                command(ser, "cal off")
+            grid = (start, stop, points)
+        segs = segments(freq, limit=POINTS)
+        jobs = [ seg + (int(samples),) for seg in segs ]
+        data = pipeline(jobs, program=program, collect=collect, decode=decode)
+        data = stitch(data, len(segs))
+        synced = True
         return data
 
-    if dev.vid == VID and dev.pid == PID:
-        ser = serial.Serial(dev.device)
-        return sweep
+    def close():
+        # restore the ui once, when the port is closed
+        try:
+            if grid is not None:
+                with stage('restore'):
+                    if not synced:
+                        clear_state(ser)
+                    command(ser, "cal on")
+                    command(ser, "resume")  # resume 
+        except (serial.SerialException, OSError):
+            pass
+        finally:
+            ser.close()
+
+    ser = serial.Serial(device)
+    sweep.close = close
+    return sweep
 
 
-def saa2(dev):
+def saa2(device):
     FSTART = 10e3 
     FSTOP = 4400e6
     POINTS = 255
-    VID = 0x04b4
-    PID = 0x0008
 
     # most of this saa2 code was taken from nanovna-saver
     # the si5351 is used up to 140Mhz
@@ -236,76 +704,127 @@ def saa2(dev):
         send(ser, cmd)
 
     def set_sweep(ser, start, stop, points, samples):
-        step = (stop - start) / (points - 1)
+        step = (stop - start) / (points - 1) if points > 1 else 0
         cmd = pack("<BBQ", CMD_WRITE8, ADDR_SWEEP_START, int(start))
         cmd += pack("<BBQ", CMD_WRITE8, ADDR_SWEEP_STEP, int(step))
         cmd += pack("<BBH", CMD_WRITE2, ADDR_SWEEP_POINTS, int(points))
         cmd += pack("<BBH", CMD_WRITE2, ADDR_SWEEP_VALS_PER_FREQ, int(samples))
         send(ser, cmd)
 
-    def read_fifo(ser, n):
-        cmd = pack("<BBB", CMD_READFIFO, ADDR_VALUES_FIFO, n)
+    # fwd, refl and thru as int32 re/im pairs, then the frequency index
+    FIFO_RECORD = [ ('fwd', '<i4', 2), ('refl', '<i4', 2), 
+                    ('thru', '<i4', 2), ('index', '<i2'), ('pad', 'V6') ]
+    FIFO_RECORD_SIZE = calcsize('<6ih6x')
+
+    def request_fifo(ser, n):
+        # the fifo count is a single byte
+        cmd = b''
+        for i in range(0, n, 255):
+            count = min(255, n - i)
+            cmd += pack("<BBB", CMD_READFIFO, ADDR_VALUES_FIFO, count)
         send(ser, cmd)
-        return ser.read(32 * n)
+
+    def decode_fifo(fifo, points, samples):
+        d = np.frombuffer(fifo, dtype=FIFO_RECORD)
+        if len(d) != points * samples:
+            raise RuntimeError('Short read from SAA2 FIFO.')
+        index = np.repeat(np.arange(points), samples)
+        if np.any(d['index'] != index):
+            raise RuntimeError('SAA2 FIFO returned points out of order.')
+        fwd = d['fwd'] @ [ 1, 1j ]
+        refl = d['refl'] @ [ 1, 1j ]
+        thru = d['thru'] @ [ 1, 1j ]
+        data = np.stack([ refl / fwd, thru / fwd ], axis=-1)
+        # records are grouped by frequency, samples within each
+        return data.reshape(points, samples, 2).transpose(1, 0, 2)
 
     def exit_usbmode(ser):
         cmd = pack("<BBB", CMD_WRITE, ADDR_RAW_SAMPLES_MODE, 2)
         send(ser, cmd)
 
-    def sweep(start, stop, points, samples):
-        start, stop, points = round(start), round(stop), int(points)
-        assert(stop >= start)
-        assert(start >= FSTART and stop <= FSTOP)
-        assert(points > 0 and points <= POINTS)
-        data = []
+    def program(job):
+        start, stop, points, count = job
+        with stage('program'):
+            set_sweep(ser, start, stop, points, count)
+            clear_fifo(ser)  # ensures the first point is 0
+            request_fifo(ser, points * count)
+
+    def collect(job):
+        start, stop, points, count = job
+        with stage('transfer') as st:
+            fifo = ser.read(FIFO_RECORD_SIZE * points * count)
+            st.nbytes = len(fifo)
+        return fifo
+
+    def decode(job, fifo):
+        start, stop, points, count = job
+        with stage('decode'):
+            return decode_fifo(fifo, points=points, samples=count)
+
+    def sweep(freq, samples, bulk=False):
+        assert(len(freq) > 0 and np.all(np.diff(freq) > 0))
+        assert(freq[0] >= FSTART and freq[-1] <= FSTOP)
+        # with bulk all samples are taken in one programmed sweep
+        # using the values per frequency register
+        repeat, count = (1, samples) if bulk else (samples, 1)
+        segs = segments(freq, limit=POINTS, whole=True)
+        jobs = [ seg + (count,) for seg in segs for i in range(repeat) ]
         try:
-            for n in range(samples):
-                set_sweep(ser, start, stop, points, 1)
-                clear_fifo(ser)  # ensures the first point is 0
-                fifo = read_fifo(ser, points)
-                for i in range(points):
-                    d = unpack_from("<iiiiiihxxxxxx", fifo, i * 32)
-                    fwd = complex(d[0], d[1])
-                    refl = complex(d[2], d[3])
-                    thru = complex(d[4], d[5])
-                    index = d[6]
-                    assert(index == i)
-                    data.append([ refl / fwd, thru / fwd ])
-            data = np.reshape(data, (samples, points, 2))
+            data = pipeline(jobs, program=program, collect=collect, decode=decode)
+            data = stitch(data, len(segs))
         finally:
             exit_usbmode(ser)
         return data
 
-    if dev.vid == VID and dev.pid == PID:
-        ser = serial.Serial(dev.device)
-        return sweep
+    ser = serial.Serial(device)
+    sweep.close = ser.close
+    return sweep
+
+
+# usb vendor and product ids of each driver
+DRIVERS = {
+    'nanovna': (nanovna, 0x0483, 0x5740),
+    'saa2': (saa2, 0x04b4, 0x0008),
+}
+
+# ports probed along with the usb ports, such as simulators
+EXTRA_PORTS = []
 
+PROBE_TTL = 2  # seconds an enumeration of the usb ports is reused
+probe_cache = {}
 
-def probe_devices():
+
+def probe_devices(refresh=False):
+    # (driver name, device) of each matching port, nothing is opened
+    now = time.monotonic()
+    if refresh or 'time' not in probe_cache or now - probe_cache['time'] >= PROBE_TTL:
+        probe_cache['ports'] = list_ports.comports(include_links=True)
+        probe_cache['time'] = now
     data = []
-    for fn in [ nanovna, saa2 ]:
-        for dev in list_ports.comports(include_links=True):
-            sweep = fn(dev)
-            if sweep is not None:
-                data.append((sweep, dev))
+    for dev in probe_cache['ports'] + EXTRA_PORTS:
+        for name, (fn, vid, pid) in DRIVERS.items():
+            if dev.vid == vid and dev.pid == pid:
+                data.append((name, dev.device))
     return data
 
 
 def list_devices():
-    data = probe_devices()
-    for i in range(len(data)):
-        fn, dev = data[i]
-        m = re.match(r'<function (\w+)', str(fn))
-        print("{}: {}".format(m.group(1), dev.device), file=sys.stderr)
+    for name, device in probe_devices():
+        print("{}: {}".format(name, device), file=sys.stderr)
 
 
-def getport(device):
-    data = probe_devices()
+def getport(device, refresh=False):
+    # a device given as driver:path is opened without probing
+    name, sep, path = (device or '').partition(':')
+    if sep and name in DRIVERS:
+        return DRIVERS[name][0](path)
+    with stage('probe'):
+        data = probe_devices(refresh=refresh)
     if len(data) == 0:
         raise RuntimeError("No NanoVNA device found.")
-    for fn, dev in data:
-        if device is None or device == dev.device:
-            return fn
+    for name, path in data:
+        if device is None or device == path:
+            return DRIVERS[name][0](path)
     print("Use --device to select the NanoVNA to use:", file=sys.stderr)
     raise RuntimeError("No NanoVNA device found")
 
@@ -332,42 +851,187 @@ def calibrate(cal):
     return d
 
 
-def cal_correct(cal, data):
-    d = calibrate(cal)
-    S11M = data[:,0]
-    S21M = data[:,1]
-    S11 = (S11M - d['e00']) / (S11M * d['e11'] - d['de'])
-    S21 = S21M / d['e10e32'] * d['e10e01'] / (d['e11'] * S11M - d['de'])
-    return np.array([ S11, S21 ]).T
+def cal_terms(cal):
+    # error terms are computed once per set of standards and kept in cal
+    if any(name not in cal for name in TERMS):
+        cal.update(calibrate(cal))
+    return { name: cal[name] for name in TERMS }
+
+
+def cal_correct(cal, data, dtype=None):
+    # data is a (points, 2) sweep or a stack of them, corrected in one
+    # pass.  dtype sets the precision of the result and the arithmetic
+    d = cal_terms(cal)
+    if dtype is not None:
+        d = { k: np.asarray(v, dtype=dtype) for k, v in d.items() }
+        data = np.asarray(data, dtype=dtype)
+    S11M = data[...,0]
+    S21M = data[...,1]
+    # S11 and S21 share the same denominator, the results are
+    # written in place to keep temporaries out of large stacks
+    k = S11M * d['e11']
+    k -= d['de']
+    np.reciprocal(k, out=k)
+    out = np.empty(k.shape + (2,), dtype=k.dtype)
+    np.subtract(S11M, d['e00'], out=out[...,0])
+    out[...,0] *= k
+    k *= d['e10e01'] / d['e10e32']
+    np.multiply(S21M, k, out=out[...,1])
+    return out
+
+
+def log_frequencies(start, stop, points):
+    # geometric spacing approximated by linear runs, each covering
+    # about a half octave, so it maps onto a few device segments
+    runs = int(np.ceil(2 * np.log2(stop / start)))
+    runs = max(1, min(runs, points - 1))
+    edges = np.geomspace(start, stop, runs + 1)
+    index = np.round(np.linspace(0, points - 1, runs + 1))
+    return np.interp(np.arange(points), index, edges)
+
+
+def parse_frequencies(spec, files=True):
+    # a file or comma separated list of frequencies and 
+    # start:stop:points bands, add :log for a log band
+    if files and os.path.isfile(spec):
+        with open(spec) as f:
+            spec = f.read()
+    freq = []
+    for d in re.split(r'[,\s]+', spec.strip()):
+        d = d.split(':')
+        try:
+            if len(d) == 1:
+                freq.append([ float(d[0]) ])
+            elif len(d) == 3 or len(d) == 4 and d[3] == 'log':
+                fn = log_frequencies if len(d) == 4 else np.linspace
+                freq.append(fn(float(d[0]), float(d[1]), int(d[2])))
+            else:
+                raise ValueError
+        except ValueError:
+            raise RuntimeError('Bad frequency list entry: {}'.format(':'.join(d)))
+    return np.unique(np.concatenate(freq))
+
+
+def cal_grid(cal, start=None, stop=None, points=None, scale=None, freq=None):
+    # the grid given by the arguments, the calibration's where not given
+    if freq is not None:
+        freq = np.asarray(freq, dtype=float)
+        return { 'start': freq[0], 'stop': freq[-1], 'points': len(freq), 
+                 'scale': 'list', 'freq': freq }
+    d = { 'start': start or cal['start'], 'stop': stop or cal['stop'],
+          'points': points or cal['points'], 'scale': scale or cal_scale(cal) }
+    if d['scale'] == 'list':
+        if start or stop or points:
+            d['scale'] = 'lin'
+        else:
+            d['freq'] = cal['freq']
+    return d
+
+
+def cal_scale(cal):
+    return str(cal.get('scale', 'lin'))
 
 
 def cal_frequencies(cal):
     start = cal['start']
     stop = cal['stop']
     points = cal['points']
-    freq = np.linspace(start, stop, points)
+    scale = cal_scale(cal)
+    if scale == 'list':
+        freq = cal['freq']
+    elif scale == 'log':
+        freq = log_frequencies(start, stop, points)
+    else:
+        freq = np.linspace(start, stop, points)
     return freq
 
 
-def cal_interpolate(cal, start, stop, points):
-    if start != cal['start'] or stop != cal['stop'] or points != cal['points']:
-        freq = cal_frequencies(cal=cal)
-        cal['start'] = start or cal['start']
-        cal['stop'] = stop or cal['stop'] 
-        cal['points'] = points or cal['points'] 
-        freq_new = cal_frequencies(cal=cal)
-        for name in cal.keys():
-            data = cal[name]
-            if np.ndim(data) and data.size > 1:
-                cal[name] = np.interp(freq_new, freq, data)
+cal_cache = OrderedDict()
+
+
+def cal_path(calfile):
+    # the store directory, a .npz name is that of an old calibration file
+    root, ext = os.path.splitext(calfile)
+    return root if ext.lower() == '.npz' else calfile
+
+
+def cal_cachedir(calfile):
+    return cal_path(calfile) + '.cache'
+
+
+def cache_name(cachedir, key):
+    name = hashlib.sha1(repr(key).encode()).hexdigest()
+    return os.path.join(cachedir, name + '.npz')
+
+
+def cache_read(cachedir, key):
+    try:
+        d = dict(np.load(cache_name(cachedir, key)))
+        d['scale'] = str(d['scale'])
+        return d
+    except (FileNotFoundError, ValueError, OSError):
+        return None
+
 
+def cache_write(cachedir, key, cal):
+    filename = cache_name(cachedir, key)
+    os.makedirs(cachedir, exist_ok=True)
+    with open(filename + '.tmp', 'wb') as f:
+        np.savez(f, **cal)
+    os.replace(filename + '.tmp', filename)
 
-def cal_init(start, stop, points, samples, average, calfile):
+
+def cache_clear(calhash, cachedir=None):
+    for key in [ key for key in cal_cache if key[0] == calhash ]:
+        del cal_cache[key]
+    if cachedir and os.path.isdir(cachedir):
+        for name in os.listdir(cachedir):
+            os.remove(os.path.join(cachedir, name))
+
+
+def cal_interpolate(cal, start, stop, points, scale=None, freq=None, cachedir=None):
+    grid = cal_grid(cal, start=start, stop=stop, points=points, scale=scale, freq=freq)
+    freq = cal_frequencies(cal=cal)
+    freq_new = cal_frequencies(cal=grid)
+    if np.array_equal(freq, freq_new):
+        return
+    # interpolated sets are keyed by the content of the
+    # calibration file and both grids
+    calhash = cal.get('hash')
+    key = (calhash, hashlib.sha1(freq.tobytes()).hexdigest(),
+           hashlib.sha1(freq_new.tobytes()).hexdigest())
+    d = cal_cache.get(key)
+    if d is None and calhash and cachedir:
+        d = cache_read(cachedir, key)
+    if d is None:
+        d = grid
+        for name in STANDARDS:
+            data = cal.get(name)
+            if np.ndim(data) and data.size > 1:
+                d[name] = np.interp(freq_new, freq, data)
+        d.update(calibrate({ **cal, **d }))
+        if calhash and cachedir:
+            cache_write(cachedir, key, d)
+    if calhash:
+        cal_cache[key] = d
+        cal_cache.move_to_end(key)
+        while len(cal_cache) > CACHE_SIZE:
+            cal_cache.popitem(last=False)
+    cal.update(d)
+
+
+def cal_init(start, stop, points, samples, average, bulk, calfile, scale=None, freq=None,
+             target=None, calname=None):
     start = DEFAULT_FSTART if start is None else start
     stop = DEFAULT_FSTOP if stop is None else stop
     points = DEFAULT_POINTS if points is None else points
+    scale = 'lin' if scale is None else scale
+    if freq is not None:
+        freq = np.asarray(freq, dtype=float)
+        start, stop, points, scale = freq[0], freq[-1], len(freq), 'list'
     samples = DEFAULT_SAMPLES if samples is None else samples
     average = bool(average)
+    bulk = bool(bulk)
     points = int(points)
     samples = int(samples)
     assert(start > 0)
@@ -375,31 +1039,189 @@ def cal_init(start, stop, points, samples, average, calfile):
     assert(stop > start)
     assert(points > 0)
     assert(samples > 0)
-    np.savez(calfile, start=start, stop=stop, points=points, 
-             average=average, samples=samples)
+    scalars = { 'start': float(start), 'stop': float(stop), 'points': points, 
+                'scale': scale, 'average': average, 'bulk': bulk, 'samples': samples }
+    if target is not None:
+        assert(target > 0)
+        scalars['target'] = float(target)
+    path = cal_path(calfile)
+    store_migrate(path)
+    store_update(path, calname or CALNAME, scalars=scalars, replace=True,
+                 arrays={} if freq is None else { 'freq': freq })
+
+
+def cal_load(calfile, calname=None):
+    path = cal_path(calfile)
+    calname = calname or CALNAME
+    store_migrate(path)
+    # an update may remove the arrays of the header just read
+    for retry in (True, False):
+        header = store_read(path)
+        if header is None:
+            raise RuntimeError('No calibration file, please initialize.')
+        entry = header['cals'].get(calname)
+        if entry is None:
+            raise RuntimeError('No calibration named {}, please initialize.'.format(calname))
+        cal = { k: v for k, v in entry.items() if k not in ('rev', 'arrays') }
+        try:
+            for name, (filename, digest) in entry['arrays'].items():
+                cal[name] = np.load(os.path.join(path, calname, filename), mmap_mode='r')
+            break
+        except FileNotFoundError:
+            if not retry:
+                raise
+    cal['hash'] = hashlib.sha1(json.dumps(entry, sort_keys=True).encode()).hexdigest()
+    cal_terms(cal)
+    return cal
+
+
+###############################
+# calibration store
+###############################
 
+# a calibration store is a directory holding:
+#   header.json   version, then the scalars of each named calibration
+#                 with the file and sha1 of each of its arrays
+#   <name>/       arrays of a calibration as npy, memory mapped on load
+# arrays are written under new names and switched to by replacing the
+# header, so an update is atomic and leaves the other arrays alone
 
-def cal_load(calfile):
+store_lock = threading.Lock()
+
+
+def store_read(path):
+    try:
+        with open(os.path.join(path, 'header.json')) as f:
+            header = json.load(f)
+    except FileNotFoundError:
+        return None
+    if header.get('version') != CAL_VERSION:
+        raise RuntimeError('Unsupported calibration store version.')
+    return header
+
+
+def store_write(path, header):
+    filename = os.path.join(path, 'header.json')
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(header, f, indent=1, sort_keys=True)
+    os.replace(filename + '.tmp', filename)
+
+
+def store_update(path, calname, scalars={}, arrays={}, replace=False):
+    # writes arrays of one calibration then switches the header to them,
+    # replace drops everything the calibration held before
+    with store_lock:
+        header = store_read(path) or { 'version': CAL_VERSION, 'cals': {} }
+        old = header['cals'].get(calname, {})
+        entry = { 'rev': old.get('rev', 0) + 1, 'arrays': {} }
+        if not replace:
+            entry.update({ k: v for k, v in old.items() if k not in entry })
+            entry['arrays'].update(old.get('arrays', {}))
+        entry.update(scalars)
+        folder = os.path.join(path, calname)
+        os.makedirs(folder, exist_ok=True)
+        for name, value in arrays.items():
+            value = np.ascontiguousarray(value)
+            filename = '{}-{:d}.npy'.format(name, entry['rev'])
+            np.save(os.path.join(folder, filename), value)
+            entry['arrays'][name] = [ filename, hashlib.sha1(value.tobytes()).hexdigest() ]
+        header['cals'][calname] = entry
+        store_write(path, header)
+        # arrays no longer in the header, or left by a failed update
+        keep = [ filename for filename, digest in entry['arrays'].values() ]
+        for filename in os.listdir(folder):
+            if filename not in keep:
+                try:
+                    os.remove(os.path.join(folder, filename))
+                except OSError:
+                    pass
+
+
+def store_migrate(path):
+    # an old calibration file becomes the default calibration of
+    # a new store, the file itself is left in place
+    npz = path + '.npz'
+    if not os.path.exists(npz) or store_read(path) is not None:
+        return
+    old = dict(np.load(npz))
+    store_update(path, CALNAME, replace=True,
+                 scalars={ k: v.item() for k, v in old.items() if not np.ndim(v) },
+                 arrays={ k: v for k, v in old.items() if np.ndim(v) })
+
+
+NPY_SCALARS = { 'f8': 'd', 'f4': 'f', 'i8': 'q', 'i4': 'i', 'u8': 'Q', 'u4': 'I', 'b1': '?' }
+
+
+def read_npy_scalar(f):
+    # the value of a 0-d npy array or None for anything else,
+    # the format is read directly so numpy is not imported
+    magic = f.read(8)
+    if magic[:6] != b'\x93NUMPY':
+        raise RuntimeError('Calibration file is not a numpy archive.')
+    size = unpack('<H', f.read(2)) if magic[6] == 1 else unpack('<I', f.read(4))
+    head = ast.literal_eval(f.read(size[0]).decode('latin1'))
+    descr = head['descr']
+    if head['shape'] != () or not isinstance(descr, str):
+        return None
+    order = '>' if descr[0] == '>' else '<'
+    kind = descr[1:]
+    if kind in NPY_SCALARS:
+        fmt = order + NPY_SCALARS[kind]
+        return unpack(fmt, f.read(calcsize(fmt)))[0]
+    if kind[0] == 'U':
+        text = f.read(4 * int(kind[1:]))
+        return text.decode('utf-32-be' if order == '>' else 'utf-32-le').rstrip('\0')
+    return None
+
+
+def npz_header(filename):
+    # the scalars of an old calibration file, arrays are given as None
+    import zipfile
     try:
-        ext = os.path.splitext(calfile)[1]
-        if ext.lower() != '.npz':
-            calfile += '.npz'
-        npzfile = np.load(calfile)
+        zf = zipfile.ZipFile(filename)
     except FileNotFoundError:
         raise RuntimeError('No calibration file, please initialize.')
-    return dict(npzfile)
-
-
-def cal_info(calfile, calibrations):
-    cal = cal_load(calfile)
+    cal = {}
+    with zf:
+        for name in zf.namelist():
+            with zf.open(name) as f:
+                cal[os.path.splitext(name)[0]] = read_npy_scalar(f)
+    return cal
+
+
+def cal_header(calfile, calname=None):
+    # the scalars of a calibration, arrays are given as None, and
+    # the names of all calibrations in the store
+    path = cal_path(calfile)
+    calname = calname or CALNAME
+    header = store_read(path)
+    if header is None:
+        return npz_header(path + '.npz'), [ CALNAME ]
+    entry = header['cals'].get(calname)
+    if entry is None:
+        raise RuntimeError('No calibration named {}, please initialize.'.format(calname))
+    cal = { k: v for k, v in entry.items() if k not in ('rev', 'arrays') }
+    cal.update({ name: None for name in entry['arrays'] })
+    return cal, sorted(header['cals'])
+
+
+def cal_info(calfile, calibrations, calname=None):
+    cal, names = cal_header(calfile, calname=calname)
     line = []
+    line.append('name:    {}'.format(calname or CALNAME))
     line.append('start:   {:.6g} MHz'.format(cal['start'] / 1e6))
     line.append('stop:    {:.6g} MHz'.format(cal['stop'] / 1e6))
     line.append('points:  {:d}'.format(cal['points']))
+    line.append('scale:   {}'.format(cal_scale(cal)))
     line.append('samples: {:d}'.format(cal['samples']))
     line.append('average: {}'.format(tobool(cal['average'])))
+    line.append('bulk:    {}'.format(tobool(cal.get('bulk', False))))
+    if cal.get('target'):
+        line.append('target:  {:.3g}'.format(cal['target']))
     units = [ d for d in calibrations if d in cal ]
     line.append('cals:    {}'.format(', '.join(units) if units else '<none>'))
+    if len(names) > 1:
+        line.append('names:   {}'.format(', '.join(names)))
     return '\n'.join(line)
 
 
@@ -408,28 +1230,416 @@ def cal_info(calfile, calibrations):
 ###############################
 
 def measure(cal, sweep):
-    samples = cal['samples']
+    # returns the reduced sweep and the standard error of each value,
+    # nan where only one sample was taken
+    samples = int(cal['samples'])
     average = cal['average']
+    bulk = bool(cal.get('bulk', False))
     freq = cal_frequencies(cal=cal)
-    data = sweep(start=freq[0], stop=freq[-1], points=len(freq), samples=samples)
-    data = np.average(data, axis=0) if average else np.median(data, axis=0)
-    return freq, data
+    if cal.get('target') and samples > MIN_SAMPLES:
+        return measure_adaptive(cal, sweep=sweep, freq=freq)
+    data = sweep(freq=freq, samples=samples, bulk=bulk)
+    with stage('reduce'):
+        noise = np.full(data.shape[1:], np.nan)
+        if samples > 1:
+            noise = np.std(data, axis=0, ddof=1) / np.sqrt(samples)
+        data = np.average(data, axis=0) if average else np.median(data, axis=0)
+    return freq, data, noise
+
+
+def welford(stats, idx, data):
+    # merges a (samples, points, 2) batch into the running count,
+    # mean and sum of squared deviations of the points in idx
+    n, mean, m2 = stats
+    k = len(data)
+    batch = data.mean(axis=0)
+    delta = batch - mean[idx]
+    total = n[idx] + k
+    mean[idx] += delta * (k / total)[:,None]
+    m2[idx] += (np.sum(np.abs(data - batch) ** 2, axis=0) + 
+                np.abs(delta) ** 2 * (n[idx] * k / total)[:,None])
+    n[idx] = total
+
+
+def rescan_points(noisy):
+    # noisy points with short gaps between them filled in
+    idx = np.flatnonzero(noisy)
+    near = np.diff(idx) <= RESCAN_GAP + 1
+    edge = np.zeros(len(noisy) + 1, dtype=int)
+    np.add.at(edge, idx[:-1][near], 1)
+    np.add.at(edge, idx[1:][near], -1)
+    return noisy | (np.cumsum(edge)[:-1] > 0)
+
+
+def measure_adaptive(cal, sweep, freq):
+    # scans are added only where the standard error is above the
+    # target, up to cal['samples'] per point
+    samples = int(cal['samples'])
+    target = float(cal['target'])
+    bulk = bool(cal.get('bulk', False))
+    points = len(freq)
+    buf = np.full((samples, points, 2), np.nan, dtype=complex)
+    stats = (np.zeros(points, dtype=int), np.zeros((points, 2), dtype=complex), 
+             np.zeros((points, 2)))
+    idx = np.arange(points)
+    data = sweep(freq=freq, samples=MIN_SAMPLES, bulk=bulk)
+    while True:
+        with stage('reduce'):
+            n = stats[0]
+            rows = n[idx] + np.arange(len(data))[:,None]
+            buf[rows, idx] = data
+            welford(stats, idx=idx, data=data)
+            noise = np.sqrt(stats[2] / ((n - 1) * n)[:,None])
+            noisy = np.any(noise > target, axis=1) & (n < samples)
+        if not np.any(noisy):
+            break
+        # enough scans for the typical noisy point to reach the target
+        need = np.max(noise[noisy] / target, axis=1) ** 2 * n[noisy] - n[noisy]
+        k = int(np.clip(np.ceil(np.median(need)), 1, np.min(samples - n[noisy])))
+        scan = rescan_points(noisy)
+        data = sweep(freq=freq[scan], samples=k, bulk=bulk)[:,noisy[scan]]
+        idx = np.flatnonzero(noisy)
+    with stage('reduce'):
+        data = stats[1] if cal['average'] else np.nanmedian(buf, axis=0)
+    return freq, data, noise
+
+
+def do_calibration(sweep, unit, calfile, calname=None):
+    # only the standard and the error terms are written
+    cal = cal_load(calfile, calname=calname)
+    freq, data, noise = measure(cal=cal, sweep=sweep)
+    arrays = { unit: data[:,0] }
+    if unit == 'thru':
+        arrays['thru21'] = data[:,1]
+    cal.update(arrays)
+    arrays.update({ k: np.broadcast_to(v, freq.shape) for k, v in calibrate(cal).items() })
+    cache_clear(cal.pop('hash'), cachedir=cal_cachedir(calfile))
+    store_update(cal_path(calfile), calname or CALNAME, arrays=arrays)
+
+
+def do_sweep(cal, start, stop, points, sweep, scale=None, freq=None, 
+             cachedir=None, log=None):
+    with stage('interpolate'):
+        cal_interpolate(cal=cal, start=start, stop=stop, points=points, 
+                        scale=scale, freq=freq, cachedir=cachedir)
+    freq, data, noise = measure(cal=cal, sweep=sweep)
+    if log is not None:
+        log.append(freq=freq, data=data, cal=cal)
+    with stage('correct'):
+        data = cal_correct(cal=cal, data=data)
+    return freq, data, noise
+
+
+def do_stream(cal, start, stop, points, sweep, scale=None, freq=None, 
+              count=None, cachedir=None, log=None):
+    with stage('interpolate'):
+        cal_interpolate(cal=cal, start=start, stop=stop, points=points, 
+                        scale=scale, freq=freq, cachedir=cachedir)
+    n = 0
+    while count is None or n < count:
+        freq, data, noise = measure(cal=cal, sweep=sweep)
+        if log is not None:
+            log.append(freq=freq, data=data, cal=cal)
+        with stage('correct'):
+            data = cal_correct(cal=cal, data=data)
+        yield freq, data, noise
+        n += 1
 
 
-def do_calibration(sweep, unit, calfile):
-    cal = cal_load(calfile)
-    freq, data = measure(cal=cal, sweep=sweep)
-    cal[unit] = data[:,0]
-    if unit == 'thru':
-        cal['thru21'] = data[:,1]
-    np.savez(calfile, **cal)
+###############################
+# refinement
+###############################
+
+def find_features(freq, data):
+    # peaks and nulls of the magnitude and zero crossings of the phase
+    # as (kind, index), steepest first.  a zero crossing lies between
+    # index and index + 1
+    if len(freq) < 3:
+        return []
+    mag = np.abs(data)
+    ph = np.angle(data)
+    d = np.diff(mag)
+    found = [ ('peak', i + 1) for i in np.flatnonzero((d[:-1] > 0) & (d[1:] <= 0)) ]
+    found += [ ('null', i + 1) for i in np.flatnonzero((d[:-1] < 0) & (d[1:] >= 0)) ]
+    # a sign change across +-180 degrees is a wrap, not a crossing
+    cross = (np.sign(ph[:-1]) != np.sign(ph[1:])) & (np.abs(np.diff(ph)) < np.pi)
+    found += [ ('zero', i) for i in np.flatnonzero(cross) ]
+    rate = np.abs(np.gradient(data, freq))
+    return sorted(found, key=lambda k: -rate[k[1]])
+
+
+def bracket(kind, freq, i):
+    # the span known to hold a feature found at index i
+    n = len(freq)
+    lo, hi = (i - 1, i + 2) if kind == 'zero' else (i - 1, i + 1)
+    return freq[max(lo, 0)], freq[min(hi, n - 1)]
+
+
+def locate(kind, freq, data):
+    # index of the feature of this kind nearest the middle of a window
+    if kind == 'peak':
+        return int(np.argmax(np.abs(data)))
+    if kind == 'null':
+        return int(np.argmin(np.abs(data)))
+    i = [ j for k, j in find_features(freq, data) if k == kind ]
+    if i:
+        return min(i, key=lambda j: abs(j - len(freq) / 2))
+
+
+def estimate(kind, freq, data, i):
+    # feature frequency between the swept points, a parabola through
+    # the magnitude for peaks and nulls, a line through the phase
+    # for zero crossings
+    if kind == 'zero':
+        ph = np.angle(data[i:i+2])
+        return freq[i] + (freq[i+1] - freq[i]) * ph[0] / (ph[0] - ph[1])
+    if i == 0 or i == len(freq) - 1:
+        return freq[i]
+    y0, y1, y2 = np.abs(data[i-1:i+2])
+    den = y0 - 2 * y1 + y2
+    if den == 0:
+        return freq[i]
+    return freq[i] + (freq[i+1] - freq[i]) * (y0 - y2) / den / 2
+
+
+def refine(sweep, freq, data, column=1, windows=REFINE_WINDOWS, 
+           points=REFINE_POINTS, resolution=1):
+    # re-sweeps narrowing windows around the steepest features of a
+    # coarse sweep until the step is down to resolution hertz, at least
+    # one, or the windows stop narrowing.  sweep takes start,
+    # stop and points.  returns the merged sweeps and the estimated
+    # (kind, frequency) of each feature
+    parts = [ (freq, data) ]
+    features = []
+    lo, hi = np.ceil(freq[0]), np.floor(freq[-1])
+    for kind, i in find_features(freq, data[:,column])[:windows]:
+        f, d = freq, data
+        for _ in range(REFINE_PASSES):
+            if (f[-1] - f[0]) / (len(f) - 1) <= max(resolution, 1):
+                break
+            start, stop = bracket(kind, f, i)
+            start, stop = max(np.floor(start), lo), min(np.ceil(stop), hi)
+            # the devices sweep whole hertz, finer is left to estimate
+            step = max(np.ceil((stop - start) / (points - 1)), np.ceil(resolution), 1)
+            n = int(np.ceil((stop - start) / step)) + 1
+            start = max(min(start, hi - (n - 1) * step), lo)
+            stop = start + (n - 1) * step
+            if n < 3 or stop > hi or stop - start >= f[-1] - f[0]:
+                break
+            f, d = sweep(start=start, stop=stop, points=n)
+            parts.append((f, d))
+            j = locate(kind, f, d[:,column])
+            if j is None:
+                break
+            i = j
+        features.append((kind, float(estimate(kind, f, d[:,column], i))))
+    freq = np.concatenate([ f for f, d in parts ])
+    data = np.concatenate([ d for f, d in parts ])
+    freq, index = np.unique(freq, return_index=True)
+    return freq, data[index], sorted(features, key=lambda k: k[1])
+
+
+def do_capture(cal, start, stop, points, sweep, frames, raw=False, dtype='complex64',
+               scale=None, freq=None, cachedir=None, log=None):
+    # a (frames, points, 2) stack of sweeps, each one reduced from the
+    # calibration samples or with raw a single scan, corrected together.
+    # returns the time each frame was taken, raw scans are spread
+    # evenly over their sweep
+    with stage('interpolate'):
+        cal_interpolate(cal=cal, start=start, stop=stop, points=points, 
+                        scale=scale, freq=freq, cachedir=cachedir)
+    times = np.empty(frames)
+    if raw:
+        freq = cal_frequencies(cal=cal)
+        t = time.time()
+        data = sweep(freq=freq, samples=frames, bulk=bool(cal.get('bulk', False)))
+        times[:] = np.linspace(t, time.time(), frames + 1)[1:]
+        data = data.astype(dtype, copy=False)
+    else:
+        data = None
+        for i in range(frames):
+            freq, d, noise = measure(cal=cal, sweep=sweep)
+            times[i] = time.time()
+            if data is None:
+                data = np.empty((frames,) + d.shape, dtype=dtype)
+            data[i] = d
+    if log is not None:
+        for t, d in zip(times, data):
+            log.append(freq=freq, data=d, cal=cal, stamp=t)
+    with stage('correct'):
+        data = cal_correct(cal=cal, data=data, dtype=dtype)
+    return times, freq, data
+
+
+def open_log(path, cal, ring=None, **kwargs):
+    # the log is sized for the grid that will be swept
+    from .sweeplog import SweepLog, DEFAULT_CAPACITY
+    grid = cal_grid(cal, **kwargs)
+    capacity = ring or DEFAULT_CAPACITY
+    return SweepLog(path, points=grid['points'], capacity=capacity, ring=bool(ring))
 
 
-def do_sweep(cal, start, stop, points, sweep):
-    cal_interpolate(cal=cal, start=start, stop=stop, points=points)
-    freq, data = measure(cal=cal, sweep=sweep)
-    data = cal_correct(cal=cal, data=data)
-    return freq, data
+###############################
+# session
+###############################
+
+class Session:
+    # keeps the device open between sweeps, the instance is
+    # called like the function returned by getvna
+
+    def __init__(self, device=None, calfile=CALFILE, cache=False, calname=None):
+        self.device = device
+        self.calfile = calfile
+        self.calname = calname
+        self.cachedir = cal_cachedir(calfile) if cache else None
+        self.cal = None
+        self.port = None
+        self.log = None
+        self.noise = None  # standard error of the last sweep
+        self.features = None  # resonances found by the last refine
+        self.times = None  # frame times of the last capture
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def open(self, refresh=False):
+        if self.port is None:
+            self.port = getport(self.device, refresh=refresh)
+        return self
+
+    def close(self):
+        port, self.port = self.port, None
+        if port is not None:
+            try:
+                port.close()
+            except (serial.SerialException, OSError):
+                pass
+
+    def sweep(self, freq, samples, bulk=False):
+        # uncalibrated sweep, if the usb link dropped the
+        # device is probed and opened again once
+        for retry in (True, False):
+            try:
+                self.open(refresh=not retry)
+                return self.port(freq=freq, samples=samples, bulk=bulk)
+            except (serial.SerialException, OSError):
+                self.close()
+                if not retry:
+                    raise RuntimeError('Lost connection to the NanoVNA device.')
+
+    def __call__(self, start=None, stop=None, points=None, filename=None, 
+                 scale=None, freq=None, log=None):
+        if filename is not None:
+            ext = os.path.splitext(filename)[1]
+            if ext != '.s1p' and ext != '.s2p':
+                raise ValueError
+        if self.cal is None:
+            self.cal = cal_load(self.calfile, calname=self.calname)
+        cal = self.cal.copy()
+        freq, data, self.noise = do_sweep(cal=cal, start=start, stop=stop, points=points, 
+                              scale=scale, freq=freq, sweep=self.sweep, 
+                              cachedir=self.cachedir, 
+                              log=self.log if log is None else log)
+        if filename is not None:
+            text = write_touchstone(freq=freq, data=data, gamma=ext=='.s1p')
+            with open(filename, 'w') as f: 
+                f.write(text)
+        return freq, data
+
+    def refine(self, start=None, stop=None, points=None, column=1, 
+               windows=REFINE_WINDOWS, window_points=REFINE_POINTS, resolution=1):
+        # a coarse sweep refined around its resonances, returned as
+        # one non-uniform sweep
+        freq, data = self(start=start, stop=stop, points=points)
+        freq, data, self.features = refine(
+            self, freq=freq, data=data, column=column, windows=windows,
+            points=window_points, resolution=resolution)
+        return freq, data
+
+    def capture(self, frames, start=None, stop=None, points=None, raw=False,
+                dtype='complex64', scale=None, freq=None, log=None):
+        # frames sweeps, or raw single scans, as one corrected stack
+        if self.cal is None:
+            self.cal = cal_load(self.calfile, calname=self.calname)
+        cal = self.cal.copy()
+        self.times, freq, data = do_capture(
+            cal=cal, start=start, stop=stop, points=points, sweep=self.sweep,
+            frames=frames, raw=raw, dtype=dtype, scale=scale, freq=freq,
+            cachedir=self.cachedir, log=self.log if log is None else log)
+        return freq, data
+
+    def stream(self, start=None, stop=None, points=None, count=None,
+               scale=None, freq=None, log=None):
+        # yields corrected sweeps as they arrive, forever if count is None
+        if self.cal is None:
+            self.cal = cal_load(self.calfile, calname=self.calname)
+        cal = self.cal.copy()
+        for freq, data, self.noise in do_stream(
+                cal=cal, start=start, stop=stop, points=points,
+                scale=scale, freq=freq, sweep=self.sweep, 
+                count=count, cachedir=self.cachedir, 
+                log=self.log if log is None else log):
+            yield freq, data
+
+
+def run_all(fns):
+    # the blocking serial calls release the gil, so running
+    # each device in its own thread lets the sweeps overlap
+    if len(fns) == 1:
+        return [ fns[0]() ]
+    from concurrent import futures
+    preload()
+    with futures.ThreadPoolExecutor(max_workers=len(fns)) as pool:
+        pending = [ pool.submit(fn) for fn in fns ]
+        return [ f.result() for f in pending ]
+
+
+def sweep_all(sessions, **kwargs):
+    fns = [ partial(s, **kwargs) for s in sessions ]
+    return run_all(fns)
+
+
+async def asweep_all(sessions, **kwargs):
+    import asyncio
+    preload()
+    loop = asyncio.get_running_loop()
+    fns = [ partial(s, **kwargs) for s in sessions ]
+    return await asyncio.gather(*[ loop.run_in_executor(None, fn) for fn in fns ])
+
+
+def stream_all(sessions, **kwargs):
+    # yields a list holding one sweep per session each round
+    streams = [ s.stream(**kwargs) for s in sessions ]
+    while True:
+        frames = run_all([ partial(next, st, None) for st in streams ])
+        if any(d is None for d in frames):
+            break
+        yield frames
+
+
+def report(sessions, frames, gamma, fmt, stamp=None):
+    with stage('format'):
+        write_report(sessions, frames=frames, gamma=gamma, fmt=fmt, stamp=stamp)
+
+
+def write_report(sessions, frames, gamma, fmt, stamp=None):
+    if fmt not in TOUCHSTONE_FORMATS:
+        file = sys.stdout.buffer
+        for freq, data in frames:
+            dump_binary(freq=freq, data=data, file=file, gamma=gamma, fmt=fmt, stamp=stamp)
+        file.flush()
+        return
+    file = sys.stdout
+    if stamp is not None:
+        file.write('! {}\n'.format(datetime.datetime.fromtimestamp(stamp).isoformat()))
+    for session, (freq, data) in zip(sessions, frames):
+        if len(sessions) > 1:
+            file.write('! device: {}\n'.format(session.device))
+        dump_touchstone(freq=freq, data=data, file=file, gamma=gamma, dtype=fmt)
+    file.flush()
 
 
 def cli(args):
@@ -444,53 +1654,89 @@ def cli(args):
     if unit and args.init:
         raise RuntimeError('Cannot initialize and calibrate as the same time.')
 
+    # pair devices with calibration files
+    devices = args.device or [ None ]
+    # each device has its own error terms, so no two may share a store
+    calfiles = args.calfile
+    if len(calfiles) != len(devices) or len(set(map(cal_path, calfiles))) != len(calfiles):
+        raise RuntimeError('Give one calibration file per device.')
+
     # show details
     if args.info:
-        text = cal_info(args.calfile, calibrations=CALIBRATIONS)
-        print(text)
+        text = [ cal_info(calfile, calibrations=CALIBRATIONS, calname=args.calname) 
+                 for calfile in calfiles ]
+        print('\n\n'.join(text))
         return
 
-    # open device
-    sweep = getport(args.device)
-
-    # operations
-    if args.init:
-        cal_init(start=args.start, stop=args.stop, points=args.points,
-                 samples=args.samples, average=args.average, 
-                 calfile=args.calfile)
-    elif unit:
-        do_calibration(sweep=sweep, unit=unit[0], calfile=args.calfile)
-    else:
-        cal = cal_load(args.calfile)
-        freq, data = do_sweep(cal=cal, start=args.start, stop=args.stop, 
-                              points=args.points, sweep=sweep)
-        text = write_touchstone(freq=freq, data=data, gamma=args.gamma)
-        print(text)
+    # frequency grid
+    scale = 'log' if args.log else None
+    freq = parse_frequencies(args.freqs) if args.freqs else None
+
+    # open devices
+    sessions = [ Session(device=d, calfile=c, cache=args.cache, calname=args.calname) 
+                 for d, c in zip(devices, calfiles) ]
+    with ExitStack() as stack:
+        for session in sessions:
+            stack.enter_context(session)
+
+        # sweep logs, one directory per device
+        if args.record and not (args.init or unit):
+            for i, session in enumerate(sessions):
+                path = args.record if len(sessions) == 1 else '{}.{}'.format(args.record, i)
+                cal = cal_load(session.calfile, calname=session.calname)
+                session.log = stack.enter_context(
+                    open_log(path, cal=cal, ring=args.ring, 
+                             start=args.start, stop=args.stop, points=args.points, 
+                             scale=scale, freq=freq))
+
+        # operations
+        if args.init:
+            for calfile in sorted(set(map(cal_path, calfiles))):
+                cal_init(start=args.start, stop=args.stop, points=args.points,
+                         samples=args.samples, average=args.average, 
+                         bulk=args.bulk, calfile=calfile, scale=scale, freq=freq,
+                         target=args.target, calname=args.calname)
+        elif unit:
+            run_all([ partial(do_calibration, sweep=s.sweep, unit=unit[0], 
+                              calfile=s.calfile, calname=s.calname)
+                      for s in sessions ])
+        elif args.serve:
+            if len(sessions) > 1:
+                raise RuntimeError('Serve one device at a time.')
+            from .server import serve
+            serve(sessions[0], address=args.serve)
+        elif args.continuous or args.count:
+            count = None if args.continuous else args.count
+            rounds = stream_all(sessions, start=args.start, stop=args.stop, 
+                                points=args.points, scale=scale, freq=freq, 
+                                count=count)
+            try:
+                for frames in rounds:
+                    report(sessions, frames=frames, gamma=args.gamma, 
+                           fmt=args.format, stamp=time.time())
+            except KeyboardInterrupt:
+                pass
+        else:
+            frames = sweep_all(sessions, start=args.start, stop=args.stop, 
+                               points=args.points, scale=scale, freq=freq)
+            report(sessions, frames=frames, gamma=args.gamma, fmt=args.format)
 
 
-def getvna(device=None, calfile=CALFILE):
-    cal_orig = cal_load(calfile)
-    def fn(start=None, stop=None, points=None, filename=None):
-        if filename is not None:
-            ext = os.path.splitext(filename)[1]
-            if ext != '.s1p' and ext != '.s2p':
-                raise ValueError
-        cal = cal_orig.copy()
-        sweep = getport(device)
-        freq, data = do_sweep(cal=cal, start=start, stop=stop,
-                              points=points, sweep=sweep)
-        if filename is not None:
-            text = write_touchstone(freq=freq, data=data, gamma=ext=='.s1p')
-            with open(filename, 'w') as f: 
-                f.write(text)
-        return freq, data
-    return fn
+def getvna(device=None, calfile=CALFILE, cache=False, calname=None):
+    session = Session(device=device, calfile=calfile, cache=cache, calname=calname)
+    session.cal = cal_load(calfile, calname=calname)
+    return session
 
 
 def main():
     args = parse_args()
-    try:
-        cli(args)
-    except RuntimeError as e:
-        print(str(e), file=sys.stderr)
+    with ExitStack() as stack:
+        if args.timings:
+            timings = stack.enter_context(Timings())
+            stack.callback(lambda: print(json.dumps(timings.stages), file=sys.stderr))
+            stack.enter_context(Stage('total'))
+        try:
+            cli(args)
+        except RuntimeError as e:
+            print(str(e), file=sys.stderr)
 
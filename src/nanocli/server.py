@@ -0,0 +1,232 @@
+
+import io, os, sys, stat, time, threading
+from collections import OrderedDict, deque
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from urllib.parse import urlparse, parse_qs
+
+from . import nanocli
+
+# a sweep server keeps one device and its calibrations loaded.  http
+# handler threads queue requests with the scheduler, whose thread is
+# the only one to touch the device:
+#   GET /sweep   start, stop, points, log, freqs, calname, format,
+#                gamma and max_age, the seconds a cached sweep may be old.
+#                freqs is only read as a list, never as a file name
+#   GET /info    calname
+# clients are told apart by an X-Client header, else by host.  all
+# unix socket clients share one host, so they should send X-Client
+
+CACHE_SIZE = 16  # most recent sweeps kept for stale requests
+
+
+class Job:
+
+    def __init__(self, key, params):
+        self.key = key
+        self.params = params
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Scheduler:
+    # requests are queued per client and taken round robin, so one busy
+    # client cannot starve the others.  a request identical to one
+    # queued or being swept waits for that sweep instead of its own
+
+    def __init__(self, session):
+        self.session = session
+        self.cond = threading.Condition()
+        self.queues = OrderedDict()  # client to deque of jobs
+        self.jobs = {}  # key to job queued or sweeping
+        self.cache = OrderedDict()  # key to (time, freq, data)
+        self.cals = {}
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+        self.thread.join()
+
+    def submit(self, client, key, params, max_age=0):
+        with self.cond:
+            hit = self.cache.get(key)
+            if hit and time.time() - hit[0] <= max_age:
+                return hit
+            job = self.jobs.get(key)
+            if job is None:
+                job = self.jobs[key] = Job(key, params)
+                self.queues.setdefault(client, deque()).append(job)
+                self.cond.notify()
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def next_job(self):
+        # the first client with work is served, then moved to the back
+        with self.cond:
+            while not self.queues and not self.stopped:
+                self.cond.wait()
+            if self.stopped:
+                return None
+            client, queue = self.queues.popitem(last=False)
+            job = queue.popleft()
+            if queue:
+                self.queues[client] = queue
+            return job
+
+    def sweep(self, calname=None, **kwargs):
+        calname = calname or self.session.calname
+        cal = self.cals.get(calname)
+        if cal is None:
+            cal = self.cals[calname] = nanocli.cal_load(self.session.calfile, calname=calname)
+        freq, data, noise = nanocli.do_sweep(
+            cal=cal.copy(), sweep=self.session.sweep, cachedir=self.session.cachedir,
+            log=self.session.log, **kwargs)
+        return freq, data
+
+    def run(self):
+        while True:
+            job = self.next_job()
+            if job is None:
+                return
+            try:
+                freq, data = self.sweep(**job.params)
+                job.result = (time.time(), freq, data)
+            except Exception as e:
+                job.error = e
+            with self.cond:
+                del self.jobs[job.key]
+                if job.error is None:
+                    self.cache[job.key] = job.result
+                    self.cache.move_to_end(job.key)
+                    while len(self.cache) > CACHE_SIZE:
+                        self.cache.popitem(last=False)
+            job.done.set()
+
+
+###############################
+# http
+###############################
+
+def sweep_params(query):
+    # the sweep arguments of a query and the key identical requests share
+    get = lambda name, fn: fn(query[name][-1]) if name in query else None
+    params = { 'start': get('start', float), 'stop': get('stop', float),
+               'points': get('points', int),
+               'scale': 'log' if get('log', int) else None,
+               'freq': get('freqs', partial(nanocli.parse_frequencies, files=False)),
+               'calname': get('calname', str) }
+    key = tuple(query.get(name, [ None ])[-1]
+                for name in ('start', 'stop', 'points', 'log', 'freqs', 'calname'))
+    return params, key
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    def reply(self, code, body, ctype='text/plain', headers={}):
+        self.send_response(code)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        try:
+            if url.path == '/sweep':
+                self.do_sweep(query)
+            elif url.path == '/info':
+                session = self.server.scheduler.session
+                calname = query.get('calname', [ session.calname ])[-1]
+                text = nanocli.cal_info(session.calfile,
+                                        calibrations=nanocli.CALIBRATIONS, calname=calname)
+                self.reply(200, (text + '\n').encode())
+            else:
+                self.reply(404, b'Not found.\n')
+        except (ValueError, KeyError, AssertionError) as e:
+            self.reply(400, 'Bad request. {}\n'.format(e).encode())
+        except RuntimeError as e:
+            self.reply(500, '{}\n'.format(e).encode())
+
+    def do_sweep(self, query):
+        fmt = query.get('format', [ 'ma' ])[-1]
+        gamma = bool(int(query.get('gamma', [ 0 ])[-1]))
+        max_age = float(query.get('max_age', [ 0 ])[-1])
+        if fmt not in nanocli.OUTPUT_FORMATS:
+            raise ValueError('Unknown format {}.'.format(fmt))
+        params, key = sweep_params(query)
+        # connections carry one request each, so they cannot name a client
+        client = self.headers.get('X-Client') or self.client_address[0]
+        stamp, freq, data = self.server.scheduler.submit(client, key, params, max_age=max_age)
+        headers = { 'X-Sweep-Time': '{:.6f}'.format(stamp) }
+        if fmt in nanocli.TOUCHSTONE_FORMATS:
+            f = io.StringIO()
+            nanocli.dump_touchstone(freq=freq, data=data, file=f, gamma=gamma, dtype=fmt)
+            self.reply(200, f.getvalue().encode(), headers=headers)
+        else:
+            f = io.BytesIO()
+            nanocli.dump_binary(freq=freq, data=data, file=f, gamma=gamma, fmt=fmt, stamp=stamp)
+            self.reply(200, f.getvalue(), ctype='application/octet-stream', headers=headers)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        # unix sockets have no client address, handlers expect one
+        request, address = super().get_request()
+        return request, ('local', 0)
+
+
+def remove_socket(path):
+    # a socket left by an earlier server, never any other file
+    try:
+        mode = os.lstat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise RuntimeError('{} exists and is not a socket.'.format(path))
+    os.remove(path)
+
+
+def make_server(address):
+    # a path is a unix socket, anything else a port or host:port,
+    # a bare port is bound to localhost only
+    if os.sep in address:
+        remove_socket(address)
+        return UnixHTTPServer(address, Handler)
+    host, sep, port = address.rpartition(':')
+    return ThreadingHTTPServer((host or 'localhost', int(port)), Handler)
+
+
+def serve(session, address):
+    # runs until interrupted
+    nanocli.preload()
+    server = make_server(address)
+    server.scheduler = Scheduler(session)
+    server.scheduler.start()
+    print('Serving {} on {}.'.format(session.device or 'nanovna', address), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.scheduler.stop()
+        if os.sep in address:
+            remove_socket(address)
@@ -0,0 +1,333 @@
+
+import os, sys, tty, time, select, argparse, threading
+import numpy as np
+from struct import pack, unpack_from, calcsize
+
+from . import nanocli
+
+# a simulated nanovna or saa2 behind a pseudo terminal, the drivers
+# open it with serial.Serial like any usb port
+
+Z0 = 50
+NANOVNA_HELP = ('Commands: help exit info echo systime threads reset freq offset '
+                'time dac saveconfig clearconfig data frequencies port stat gain '
+                'sample scan sweep test touchcal touchtest pause resume cal save '
+                'recall trace marker edelay capture vbat tcxo version')
+
+# fixture error terms seen by the simulated device, e30 is zero
+FIXTURE = { 'e00': 0.03+0.01j, 'e11': 0.05-0.02j, 'e10e01': 0.9,
+            'e22': 0.02+0.01j, 'e10e32': 0.8, 'delay': 0.5e-9 }
+
+
+###############################
+# devices under test
+###############################
+
+def smatrix(s11=0, s21=0, s12=None, s22=0):
+    # s-parameters broadcast into (points, 2, 2) matrices
+    s12 = s21 if s12 is None else s12
+    s11, s21, s12, s22 = np.broadcast_arrays(s11, s21, s12, s22)
+    return np.stack([ np.stack([ s11, s12 ], axis=-1),
+                      np.stack([ s21, s22 ], axis=-1) ], axis=-2).astype(complex)
+
+
+def resonator(f0=10e6, q=50, r=5):
+    # series rlc between the ports
+    L = q * r / (2 * np.pi * f0)
+    C = 1 / ((2 * np.pi * f0) ** 2 * L)
+    def dut(freq):
+        w = 2 * np.pi * np.asarray(freq, dtype=float)
+        z = r + 1j * w * L + 1 / (1j * w * C)
+        s11 = z / (z + 2 * Z0)
+        return smatrix(s11=s11, s21=1 - s11, s22=s11)
+    return dut
+
+
+def crystal(fs=10e6, q=50000, r=20, c0=4e-12):
+    # motional rlc with the holder capacitance across it
+    L = q * r / (2 * np.pi * fs)
+    C = 1 / ((2 * np.pi * fs) ** 2 * L)
+    def dut(freq):
+        w = 2 * np.pi * np.asarray(freq, dtype=float)
+        zm = r + 1j * w * L + 1 / (1j * w * C)
+        z = zm / (1 + 1j * w * c0 * zm)
+        s11 = z / (z + 2 * Z0)
+        return smatrix(s11=s11, s21=1 - s11, s22=s11)
+    return dut
+
+
+DUTS = {
+    'open': lambda freq: smatrix(s11=np.ones(len(freq))),
+    'short': lambda freq: smatrix(s11=-np.ones(len(freq))),
+    'load': lambda freq: smatrix(s11=np.zeros(len(freq))),
+    'thru': lambda freq: smatrix(s21=np.ones(len(freq))),
+    'resonator': resonator(),
+    'crystal': crystal(),
+}
+
+
+def measured(freq, dut, fixture=FIXTURE):
+    # raw s11 and s21 the device reports for the dut behind the fixture
+    freq = np.asarray(freq, dtype=float)
+    s = dut(freq)
+    s11, s12, s21, s22 = s[:,0,0], s[:,0,1], s[:,1,0], s[:,1,1]
+    line = np.exp(-2j * np.pi * freq * fixture['delay'])
+    e00, e11, e22 = fixture['e00'], fixture['e11'], fixture['e22']
+    e10e01 = fixture['e10e01'] * line ** 2
+    e10e32 = fixture['e10e32'] * line ** 2
+    gin = s11 + s12 * s21 * e22 / (1 - s22 * e22)
+    m11 = e00 + e10e01 * gin / (1 - e11 * gin)
+    m21 = e10e32 * s21 / ((1 - e11 * s11) * (1 - e22 * s22) - e11 * e22 * s21 * s12)
+    return np.stack([ m11, m21 ], axis=-1)
+
+
+###############################
+# simulator
+###############################
+
+class Port:
+    # stands in for a list_ports entry
+
+    def __init__(self, device, vid, pid):
+        self.device = device
+        self.vid = vid
+        self.pid = pid
+
+    def __str__(self):
+        return '{} - simulator'.format(self.device)
+
+
+class Simulator:
+    # kind is nanovna or saa2, dut a name in DUTS or a function of
+    # frequency returning s-matrices, latency is seconds before each
+    # reply, throughput bytes per second, dwell seconds per point
+    # and noise the deviation of complex noise on the raw values
+
+    IDS = { 'nanovna': (0x0483, 0x5740), 'saa2': (0x04b4, 0x0008) }
+
+    def __init__(self, kind='nanovna', dut='resonator', fixture=FIXTURE, binary=True,
+                 latency=0, throughput=None, dwell=0, noise=0, seed=0):
+        assert(kind in self.IDS)
+        self.kind = kind
+        self.dut = dut
+        self.fixture = fixture
+        self.binary = binary
+        self.latency = latency
+        self.throughput = throughput
+        self.dwell = dwell
+        self.noise = noise
+        self.rng = np.random.default_rng(seed)
+        self.commands = []
+        self.thread = None
+        self.master = self.slave = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    @property
+    def device(self):
+        return os.ttyname(self.slave)
+
+    @property
+    def port(self):
+        vid, pid = self.IDS[self.kind]
+        return Port(self.device, vid=vid, pid=pid)
+
+    def start(self, register=True):
+        # the slave end stays open here so the master never
+        # sees a hangup when the driver closes its port
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.inbuf = bytearray()
+        self.reset()
+        self.running = True
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+        if register:
+            nanocli.EXTRA_PORTS.append(self.port)
+        return self
+
+    def stop(self):
+        if self.thread is None:
+            return
+        nanocli.EXTRA_PORTS[:] = [ p for p in nanocli.EXTRA_PORTS if p.device != self.device ]
+        self.running = False
+        self.thread.join()
+        self.thread = None
+        os.close(self.master)
+        os.close(self.slave)
+
+    def serve(self):
+        while self.running:
+            r, _, _ = select.select([ self.master ], [], [], 0.05)
+            if r:
+                self.inbuf.extend(os.read(self.master, 4096))
+                if self.kind == 'nanovna':
+                    self.shell()
+                else:
+                    self.registers()
+
+    def send(self, data):
+        # write a reply limited to the configured throughput
+        if self.latency:
+            time.sleep(self.latency)
+        view = memoryview(data)
+        chunk = 64 if self.throughput else len(view)
+        t = time.perf_counter()
+        for i in range(0, len(view), chunk):
+            os.write(self.master, view[i:i+chunk])
+            if self.throughput:
+                t += len(view[i:i+chunk]) / self.throughput
+                time.sleep(max(0, t - time.perf_counter()))
+
+    def measure(self, freq):
+        dut = DUTS[self.dut] if isinstance(self.dut, str) else self.dut
+        d = measured(freq, dut=dut, fixture=self.fixture)
+        if self.noise:
+            d = d + self.noise * (self.rng.normal(size=d.shape) +
+                                  1j * self.rng.normal(size=d.shape)) / np.sqrt(2)
+        if self.dwell:
+            time.sleep(self.dwell * len(freq))
+        return d
+
+    def reset(self):
+        self.sweep = (50000, 900000000, 101)
+        self.regs = { 0x00: 0, 0x10: 0, 0x20: 101, 0x22: 1, 0xf0: 2, 0xf1: 1 }
+        self.fifo = 0
+
+    ### nanovna shell
+
+    def shell(self):
+        while True:
+            i = self.inbuf.find(b'\r')
+            if i < 0:
+                break
+            line = self.inbuf[:i].decode('utf-8', 'replace').strip()
+            del self.inbuf[:i+1]
+            self.commands.append(line)
+            reply = line.encode() + b'\r\n'
+            if line:
+                reply += self.run(line.split())
+            self.send(reply + nanocli.PROMPT)
+
+    def run(self, argv):
+        cmd, args = argv[0], argv[1:]
+        if cmd == 'help':
+            return (NANOVNA_HELP + (' scan_bin' if self.binary else '') + '\r\n').encode()
+        if cmd == 'version':
+            return b'1.0.0-simulator\r\n'
+        if cmd == 'sweep' and args:
+            self.sweep = tuple(int(float(a)) for a in args[:3]) + self.sweep[len(args):]
+            return b''
+        if cmd in ('cal', 'pause', 'resume'):
+            return b''
+        if cmd in ('scan', 'scan_bin') and len(args) >= 2:
+            return self.scan(args, binary=cmd=='scan_bin')
+        return '{}?\r\n'.format(cmd).encode()
+
+    def scan(self, args, binary):
+        start, stop = int(float(args[0])), int(float(args[1]))
+        points = int(args[2]) if len(args) > 2 else self.sweep[2]
+        mask = int(args[3]) if len(args) > 3 else 0
+        if points < 1 or points > 401 or start > stop:
+            return b'scan {start(Hz)} {stop(Hz)} [points] [outmask]\r\n'
+        freq = np.linspace(start, stop, points).round().astype(np.uint32)
+        d = self.measure(freq).astype(np.complex64)
+        fields = [ ('freq', '<u4', freq) ] if mask & 1 else []
+        fields += [ ('s11', '<c8', d[:,0]) ] if mask & 2 else []
+        fields += [ ('s21', '<c8', d[:,1]) ] if mask & 4 else []
+        if binary or (mask & 0x80 and self.binary):
+            rec = np.zeros(points, dtype=[ f[:2] for f in fields ])
+            for name, _, value in fields:
+                rec[name] = value
+            return pack('<HH', mask, points) + rec.tobytes()
+        line = []
+        for i in range(points):
+            text = [ '{:d}'.format(freq[i]) ] if mask & 1 else []
+            for name, _, value in fields[bool(mask & 1):]:
+                text.append('{:.9f} {:.9f}'.format(value[i].real, value[i].imag))
+            line.append(' '.join(text) + '\r\n')
+        return ''.join(line).encode()
+
+    ### saa2 registers
+
+    def registers(self):
+        # each command is complete before it is run
+        size = { 0x00: 1, 0x10: 2, 0x11: 2, 0x12: 2, 0x18: 3,
+                 0x20: 3, 0x21: 4, 0x22: 6, 0x23: 10 }
+        buf = self.inbuf
+        while buf:
+            cmd = buf[0]
+            if cmd not in size:
+                del buf[:1]
+                continue
+            if len(buf) < size[cmd]:
+                break
+            if cmd in (0x20, 0x21, 0x22, 0x23):
+                fmt = { 0x20: '<B', 0x21: '<H', 0x22: '<I', 0x23: '<Q' }[cmd]
+                self.write_register(buf[1], unpack_from(fmt, buf, 2)[0])
+            elif cmd in (0x10, 0x11, 0x12):
+                fmt = { 0x10: '<B', 0x11: '<H', 0x12: '<I' }[cmd]
+                mask = (1 << 8 * calcsize(fmt)) - 1
+                self.send(pack(fmt, self.regs.get(buf[1], 0) & mask))
+            elif cmd == 0x18:
+                self.send(self.read_fifo(buf[2]))
+            del buf[:size[cmd]]
+
+    def write_register(self, addr, value):
+        self.regs[addr] = value
+        if addr in (0x00, 0x10, 0x20, 0x22, 0x30):
+            self.fifo = 0  # a new sweep or any fifo write starts over
+
+    def read_fifo(self, count):
+        # records follow the sweep from where the fifo was cleared,
+        # values per frequency repeat each point
+        start, step = self.regs[0x00], self.regs[0x10]
+        points, vals = max(1, self.regs[0x20]), max(1, self.regs[0x22])
+        pos = self.fifo + np.arange(count)
+        index = pos // vals % points
+        self.fifo += count
+        freq = start + step * index
+        d = self.measure(freq)
+        fwd = 1e6 * np.exp(2j * np.pi * self.rng.random(count))
+        rec = np.zeros(count, dtype=[ ('fwd', '<i4', 2), ('refl', '<i4', 2),
+                                      ('thru', '<i4', 2), ('index', '<i2'), ('pad', 'V6') ])
+        for name, value in (('fwd', fwd), ('refl', fwd * d[:,0]), ('thru', fwd * d[:,1])):
+            rec[name] = np.stack([ value.real, value.imag ], axis=-1).round()
+        rec['index'] = index
+        return rec.tobytes()
+
+
+###############################
+# command line
+###############################
+
+def main():
+    # run nanocli against a simulator, arguments after -- go to nanocli
+    argv = sys.argv[1:]
+    rest = argv[argv.index('--')+1:] if '--' in argv else []
+    argv = argv[:argv.index('--')] if '--' in argv else argv
+    parser = argparse.ArgumentParser(prog='python -m nanocli.simulator',
+                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--kind', default='nanovna', choices=list(Simulator.IDS), help='device to simulate')
+    parser.add_argument('--dut', default='resonator', choices=list(DUTS), help='device under test')
+    parser.add_argument('--text', action='store_true', help='nanovna without binary scans')
+    parser.add_argument('--latency', default=0, type=float, help='seconds before each reply')
+    parser.add_argument('--throughput', type=float, help='bytes per second')
+    parser.add_argument('--dwell', default=0, type=float, help='seconds per point')
+    parser.add_argument('--noise', default=0, type=float, help='noise deviation')
+    parser.add_argument('--seed', default=0, type=int, help='noise seed')
+    args = parser.parse_args(argv)
+    with Simulator(kind=args.kind, dut=args.dut, binary=not args.text, latency=args.latency,
+                   throughput=args.throughput, dwell=args.dwell, noise=args.noise,
+                   seed=args.seed) as sim:
+        sys.argv = [ 'nanocli', '--device', '{}:{}'.format(sim.kind, sim.device) ] + rest
+        nanocli.main()
+
+
+if __name__ == '__main__':
+    main()
+
@@ -0,0 +1,176 @@
+
+import os, json, time, hashlib
+import numpy as np
+
+# a sweep log is a directory holding memory-mapped arrays:
+#   meta.json   points, columns, dtype, capacity and ring flag
+#   state.bin   int64 count of sweeps ever appended
+#   data.bin    (capacity, points, columns) raw sweep data
+#   index.bin   (capacity,) time, grid id and calibration id
+#   grids/      frequencies of each grid id as npy
+#   cals/       calibration state of each calibration id as npz
+
+VERSION = 1
+INDEX = np.dtype([ ('time', '<f8'), ('grid', '<u4'), ('cal', '<u4') ])
+DEFAULT_CAPACITY = 1024
+
+
+class SweepLog:
+
+    def __init__(self, path, points=None, columns=2, dtype=np.complex64,
+                 capacity=DEFAULT_CAPACITY, ring=False):
+        # opens an existing log, or creates it when points is given
+        self.path = path
+        meta = os.path.join(path, 'meta.json')
+        if not os.path.exists(meta):
+            if points is None:
+                raise RuntimeError('No sweep log at {}.'.format(path))
+            os.makedirs(os.path.join(path, 'grids'), exist_ok=True)
+            os.makedirs(os.path.join(path, 'cals'), exist_ok=True)
+            self.meta = { 'version': VERSION, 'points': int(points), 'columns': int(columns),
+                          'dtype': np.dtype(dtype).str, 'capacity': int(capacity),
+                          'ring': bool(ring), 'grids': {}, 'cals': {} }
+            self.write_meta()
+            np.zeros(1, dtype='<i8').tofile(os.path.join(path, 'state.bin'))
+            self.resize(int(capacity))
+        with open(meta) as f:
+            self.meta = json.load(f)
+        if self.meta['version'] != VERSION:
+            raise RuntimeError('Unsupported sweep log version.')
+        self.state = np.memmap(os.path.join(path, 'state.bin'), dtype='<i8', mode='r+')
+        self.map()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return min(self.refresh(), self.meta['capacity'])
+
+    def write_meta(self):
+        filename = os.path.join(self.path, 'meta.json')
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(self.meta, f)
+        os.replace(filename + '.tmp', filename)
+
+    def shape(self, capacity):
+        return (capacity, self.meta['points'], self.meta['columns'])
+
+    def resize(self, capacity):
+        # grow the files in place, existing records keep their offsets
+        itemsize = np.dtype(self.meta['dtype']).itemsize
+        size = { 'data.bin': int(np.prod(self.shape(capacity))) * itemsize,
+                 'index.bin': capacity * INDEX.itemsize }
+        for name, nbytes in size.items():
+            with open(os.path.join(self.path, name), 'ab') as f:
+                f.truncate(nbytes)
+        self.meta['capacity'] = capacity
+        self.write_meta()
+
+    def refresh(self):
+        # the count of sweeps, remapping first when another writer
+        # has grown the log past what this one mapped
+        count = int(self.state[0])
+        if not self.meta['ring'] and count > self.meta['capacity']:
+            with open(os.path.join(self.path, 'meta.json')) as f:
+                self.meta = json.load(f)
+            self.map()
+        return count
+
+    def map(self):
+        capacity = self.meta['capacity']
+        self.data = np.memmap(os.path.join(self.path, 'data.bin'), mode='r+',
+                              dtype=self.meta['dtype'], shape=self.shape(capacity))
+        self.index = np.memmap(os.path.join(self.path, 'index.bin'), mode='r+',
+                               dtype=INDEX, shape=(capacity,))
+
+    def close(self):
+        for d in (self.data, self.index, self.state):
+            d.flush()
+
+    def ident(self, kind, key, save):
+        # ids are handed out in order and kept in meta.json
+        table = self.meta[kind]
+        if key not in table:
+            table[key] = len(table)
+            save(os.path.join(self.path, kind, '{:d}'.format(table[key])))
+            self.write_meta()
+        return table[key]
+
+    def grid_id(self, freq):
+        freq = np.ascontiguousarray(freq, dtype='<f8')
+        key = hashlib.sha1(freq.tobytes()).hexdigest()
+        return self.ident('grids', key, lambda name: np.save(name + '.npy', freq))
+
+    def cal_id(self, cal, grid):
+        # a calibration is identified by its file contents and grid
+        key = '{}-{}'.format(cal.get('hash'), grid)
+        state = { k: v for k, v in cal.items() if k != 'hash' }
+        return self.ident('cals', key, lambda name: np.savez(name + '.npz', **state))
+
+    def append(self, freq, data, cal=None, stamp=None):
+        if len(freq) != self.meta['points']:
+            raise RuntimeError('Sweep log {} holds {} point sweeps.'.format(
+                               self.path, self.meta['points']))
+        count = int(self.state[0])
+        capacity = self.meta['capacity']
+        if count >= capacity and not self.meta['ring']:
+            self.resize(2 * capacity)
+            self.map()
+            capacity = self.meta['capacity']
+        slot = count % capacity
+        grid = self.grid_id(freq)
+        self.data[slot] = data
+        self.index[slot] = (time.time() if stamp is None else stamp, grid,
+                            0xffffffff if cal is None else self.cal_id(cal, grid))
+        # the count is written last so a partial append is never seen
+        self.state[0] = count + 1
+
+    def slot(self, i):
+        count = self.refresh()
+        n = len(self)
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError
+        if not self.meta['ring']:
+            return i
+        return (count - n + i) % self.meta['capacity']
+
+    def __getitem__(self, i):
+        # returns (time, freq, data) without loading other sweeps
+        slot = self.slot(i)
+        stamp, grid, cal = self.index[slot]
+        return stamp, self.grid(grid), self.data[slot]
+
+    def order(self):
+        # slots of all sweeps from oldest to newest
+        count = self.refresh()
+        n = len(self)
+        if not self.meta['ring']:
+            return np.arange(n)
+        return np.arange(count - n, count) % self.meta['capacity']
+
+    def times(self):
+        return self.index['time'][self.order()]
+
+    def between(self, start=None, stop=None):
+        # sweeps with start <= time < stop as (times, grid ids, data),
+        # data is a view of the log unless a ring buffer wrapped
+        times = self.times()
+        a = 0 if start is None else np.searchsorted(times, start, side='left')
+        b = len(times) if stop is None else np.searchsorted(times, stop, side='left')
+        slots = self.order()[a:b]
+        if len(slots) and slots[-1] - slots[0] == len(slots) - 1:
+            s = slice(slots[0], slots[-1] + 1)
+            return self.index['time'][s], self.index['grid'][s], self.data[s]
+        return self.index['time'][slots], self.index['grid'][slots], self.data[slots]
+
+    def grid(self, ident):
+        return np.load(os.path.join(self.path, 'grids', '{:d}.npy'.format(ident)), mmap_mode='r')
+
+    def cal(self, ident):
+        return dict(np.load(os.path.join(self.path, 'cals', '{:d}.npz'.format(ident))))
+